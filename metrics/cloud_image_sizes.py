@@ -5,74 +5,95 @@ Copyright 2018 Canonical Ltd.
 Brian Murray <brian.murray@canonical.com>
 """
 import argparse
-import json
-import subprocess
-
 from datetime import datetime
+import re
+
+from metrics.helpers import fanout
 from metrics.helpers import util
+from metrics.helpers.sstreams import ProductsContentSource, ifilter
 
-DAILY_URL = ('http://cloud-images.ubuntu.com/daily/streams/v1'
-             '/com.ubuntu.cloud:daily:download.json')
-IMAGE_TYPE = 'daily'
-IMAGE_FORMAT = 'disk1.img'
+STREAM_URL = ('http://cloud-images.ubuntu.com/{}/streams/v1'
+              '/com.ubuntu.cloud:{}:download.json')
+IMAGE_STREAMS = {
+    'daily': STREAM_URL.format('daily', 'daily'),
+    'release': STREAM_URL.format('releases', 'released'),
+}
+'''download streams to report image sizes of, by image type'''
+IMAGE_FORMATS = ['disk1.img', 'disk-kvm.img', 'root.tar.xz', 'squashfs']
+'''item ftypes to report the size of'''
 
 
 def _get_datetime_for_serial(serial: str) -> datetime:
     return datetime.strptime(serial[:8], '%Y%m%d')
 
 
-def parse_simplestreams_for_images():
+def filter_sized_images(formats=None):
     """
-    Use sstream-query to fetch supported image information.
+    Produce a filter for the items of supported images in formats.
+
+    :param formats: list of item ftypes, IMAGE_FORMATS by default
+    :return: SimpleStreams filter object
+    """
+    return ifilter('supported != False') & ifilter(
+        'ftype ~ ^({})$'.format('|'.join(
+            re.escape(fmt) for fmt in formats or IMAGE_FORMATS)))
+
 
-    This returns a dictionary of
-    {release: {arch: {'size': size_of_image}, {'version': version_name}}}.
+def parse_simplestreams_for_images(streams=None, formats=None):
     """
-    url = DAILY_URL
-    output = subprocess.check_output(['sstream-query', '--json', url])
+    Find the latest image of each release, arch and format in streams.
+
+    The streams are fetched concurrently and each is then read once, in
+    process, for all the formats. Products that are not supported are
+    skipped without looking at their items.
+
+    :param streams: dict mapping image types to download stream URLs,
+    IMAGE_STREAMS by default
+    :param formats: list of item ftypes, IMAGE_FORMATS by default
+    :return: a dict mapping (image_type, release, arch, format) tuples to
+    {'size': size_of_image, 'version': version_name}
+    """
+    streams = streams or IMAGE_STREAMS
+    item_filter = filter_sized_images(formats)
+    sources = [ProductsContentSource(url, streaming=True)
+               for url in streams.values()]
+
     image_sizes = {}
-    for product_dict in json.loads(output.decode('utf-8')):
-        if product_dict['supported'] == 'False':
-            continue
-        if product_dict['ftype'] != IMAGE_FORMAT:
-            continue
-        release = product_dict['release']
-        if release not in image_sizes:
-            image_sizes[release] = {}
-        arch = product_dict['arch']
-        if arch not in image_sizes[release]:
-            image_sizes[release][arch] = {}
-        if 'version' in image_sizes[release][arch]:
-            version = image_sizes[release][arch]['version']
-            if version > product_dict['version_name']:
+    results = fanout.iter_fan_out(lambda source: source.prefetch(), sources)
+    for image_type, result in zip(streams, results):
+        if result.error:
+            raise result.error
+        for item in result.value.get_product_items(item_filter):
+            key = (image_type, item['release'], item['arch'], item['ftype'])
+            image = image_sizes.get(key)
+            if image is not None and image['version'] > item['version_name']:
                 continue
-        image_sizes[release][arch]['version'] = product_dict['version_name']
-        image_sizes[release][arch]['size'] = product_dict['size']
+            image_sizes[key] = {'version': item['version_name'],
+                                'size': item['size']}
     return image_sizes
 
 
 def collect(dryrun=False):
     """Collect published cloud image sizes and push to InfluxDB."""
-    print('Getting size of daily images')
+    print('Getting size of {} images'.format(', '.join(IMAGE_STREAMS)))
     image_sizes = parse_simplestreams_for_images()
     data = []
-    for release in image_sizes:
-        for arch in image_sizes[release]:
-            size = image_sizes[release][arch]['size']
-            version = image_sizes[release][arch]['version']
-            print('Found {} image {} of size {} for {} {}'.format(
-                IMAGE_TYPE, IMAGE_FORMAT, size, release, arch))
-            data.append({
-                'measurement': 'cloud_images_sizes',
-                'time': _get_datetime_for_serial(version),
-                'tags': {
-                    'arch': arch,
-                    'release': release,
-                    'type': IMAGE_TYPE,
-                    'format': IMAGE_FORMAT
-                },
-                'fields': {'size': size}
-            })
+    for (image_type, release, arch, image_format), image in sorted(
+            image_sizes.items()):
+        size = image['size']
+        print('Found {} image {} of size {} for {} {}'.format(
+            image_type, image_format, size, release, arch))
+        data.append({
+            'measurement': 'cloud_images_sizes',
+            'time': _get_datetime_for_serial(image['version']),
+            'tags': {
+                'arch': arch,
+                'release': release,
+                'type': image_type,
+                'format': image_format
+            },
+            'fields': {'size': size}
+        })
 
     if not dryrun:
         print('Pushing data...')
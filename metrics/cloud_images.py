@@ -6,13 +6,15 @@ Daniel Watkins <daniel.watkins@canonical.com>
 """
 import argparse
 import datetime
+import itertools
 import os.path
 import re
 from collections import defaultdict
 import distro_info  # pylint: disable=wrong-import-order
 import pprint
-import requests
 
+from metrics.helpers import fanout
+from metrics.helpers import fetch
 from metrics.helpers.sstreams import UbuntuCloudImages, ifilter
 from metrics.helpers import util
 
@@ -29,7 +31,6 @@ INDEX_PATH_TO_IMAGE_TYPE = {
     'minimal/daily': 'daily-minimal'
 }
 
-TODAY = datetime.date.today()
 DOCKER_CORE_ROOT = 'https://partner-images.canonical.com/core'
 
 
@@ -49,10 +50,14 @@ def get_current_download_serials(download_root):
     releases.
     """
     current_serials = {}
-    for release in distro_info.UbuntuDistroInfo().supported():
-        url = os.path.join(
-            download_root, release, 'current', 'unpacked', 'build-info.txt')
-        build_info_response = requests.get(url)
+    releases = distro_info.UbuntuDistroInfo().supported()
+    urls = [os.path.join(download_root, release, 'current', 'unpacked',
+                         'build-info.txt') for release in releases]
+    responses = fanout.fan_out(fetch.get_session().get, urls)
+    for release, response in zip(releases, responses):
+        if response.error:
+            raise response.error
+        build_info_response = response.value
         if not build_info_response.ok:
             # If the release doesn't have images, we should ignore it
             continue
@@ -73,53 +78,87 @@ def get_current_download_serials(download_root):
     return current_serials
 
 
-def update_stat_entry_item(stat_lvl, serial):
+class StatEntry:  # pylint: disable=too-few-public-methods
+    """Count and latest serial of a group of simplestreams items."""
+
+    __slots__ = ('count', 'latest_serial', 'age')
+
+    def __init__(self):
+        """Construct the class."""
+        self.count = 0
+        self.latest_serial = None
+        self.age = None
+
+    def add(self, serial):
+        """
+        Count an item.
+
+        :param serial: (serial int, age) of the item as returned by
+        _parse_serial, or None for serials that are not dates
+        """
+        self.count += 1
+        if serial is not None and (self.latest_serial is None or
+                                   serial[0] > self.latest_serial):
+            self.latest_serial, self.age = serial
+
+
+class ReleaseStatEntry(StatEntry):  # pylint: disable=too-few-public-methods
+    """A StatEntry of a release with the StatEntry of each machine/arch."""
+
+    __slots__ = ('by_machine', 'by_arch')
+
+    def __init__(self):
+        """Construct the class."""
+        super().__init__()
+        self.by_machine = defaultdict(StatEntry)
+        self.by_arch = defaultdict(StatEntry)
+
+
+def _parse_serial(serial, today):
     """
-    Track a simplestream item metrics in the stat_lvl dictionary.
+    Return (serial int, age in days) of a serial string.
 
-    :param stat_lvl: the stat_entry dict, as per parse_simplestreams_for_images
     :param serial: item serial string (e.g '20181011.1')
-    :return:
+    :param today: date ages are counted to
+    :return: None for beta and LATEST serials, which are not tracked
     """
-    stat_lvl['count'] = stat_lvl.get('count', 0) + 1
-
     if 'beta' in serial or 'LATEST' in serial:
-        return
-
+        return None
     serial = _parse_serial_date_int_from_string(serial)
+    return serial, _determine_serial_age(serial, today)
 
-    current_serial = stat_lvl.get('latest_serial')
-    if current_serial is None or serial > current_serial:
-        stat_lvl['latest_serial'] = serial
-        stat_lvl['age'] = _determine_serial_age(serial)
 
+class _ParsedSerials(dict):
+    """Serial strings mapped to their _parse_serial result, parsed once."""
 
-def recursive_defaultdict():
-    """
-    Produce a recursive defaultdict.
+    def __init__(self, today):
+        super().__init__()
+        self.today = today
 
-    :return: defaultdict of defaultdicts
-    """
-    return defaultdict(recursive_defaultdict)
+    def __missing__(self, serial):
+        parsed = self[serial] = _parse_serial(serial, self.today)
+        return parsed
 
 
 def parse_simplestreams_for_images(images):
     """
     Generate metrics dict, describing `images` simplestream items collection.
 
-    :return: a dict that is structured like this:
-    daily.aws.vivid - <stat_entry>
-                  | - [by-machine] = { pv-instance: <stat_entry> }
-                  | - [by-arch] = { amd64: <stat_entry> }
-    where <stat_entry> looks like:
-        {lastest_serial: 20180901, age: 866, count: 1}
+    Serials are parsed once per distinct serial string, as many items of
+    a build share it.
+
+    :return: a dict mapping (image_type, cloud, release) tuples, e.g.
+    ('daily', 'aws', 'vivid'), to a ReleaseStatEntry whose by_machine
+    (e.g. {'pv-instance': <StatEntry>}) and by_arch (e.g.
+    {'amd64': <StatEntry>}) hold the StatEntry of each machine type and arch
     """
-    stats = recursive_defaultdict()
+    stats = defaultdict(ReleaseStatEntry)
+    serials = _ParsedSerials(datetime.date.today())
 
     for image in images:
         # simplestreams items are all of images ever published
-        # we create a 3-level deep dict to keep counters and latest_serials
-        # for them, to find out what, and how old are the latest serials
+        # we keep counters and latest_serials per release, machine type
+        # and arch to find out what, and how old are the latest serials
 
         image_type = INDEX_PATH_TO_IMAGE_TYPE[image['index_path']]
         cloudname = image.get('cloudname')
@@ -127,34 +166,32 @@ def parse_simplestreams_for_images(images):
             cloudname = 'download'
 
         release = image.get('release') or image.get('version', 'unknown')
-        serial = image.get('version_name', 'LATEST')
+        serial = serials[image.get('version_name', 'LATEST')]
         arch = image.get('arch', 'noarch')
         machine_type = '-'.join([image[f] for f in MACHINE_TYPE_FIELDS
                                  if f in image])
 
         # base stat entries
-        stat_entry = stats[image_type][cloudname][release]
-        update_stat_entry_item(stat_entry, serial)
+        stat_entry = stats[image_type, cloudname, release]
+        stat_entry.add(serial)
 
         # Some metrics we only track per machine type or arch,
-        # that is why they are kept as separate <stat_item> records
+        # that is why they are kept as separate StatEntry records
 
         # serials make sense per machine type
-        machine_lvl = stat_entry['by-machine'][machine_type]
-        update_stat_entry_item(machine_lvl, serial)
+        stat_entry.by_machine[machine_type].add(serial)
 
         # counts are tracked per arch, w/ no regard for machine type
-        arch_lvl = stat_entry['by-arch'][arch]
-        update_stat_entry_item(arch_lvl, serial)
+        stat_entry.by_arch[arch].add(serial)
 
     return stats
 
 
-def _determine_serial_age(serial):
+def _determine_serial_age(serial, today=None):
     # Trim the serial to 8 digits to comply with the YYYYMMDD format.
     serial = str(serial)[:8]
     serial_datetime = datetime.datetime.strptime(serial, '%Y%m%d')
-    return (TODAY - serial_datetime.date()).days
+    return ((today or datetime.date.today()) - serial_datetime.date()).days
 
 
 def _emit_metric(measurement, value, **kwargs):
@@ -184,11 +221,9 @@ def gen_metrics_from_stats(stats):
 
     :param stats: a dict as returned by parse_simplestreams_for_images
     """
-    for image_type, clouds in stats.items():
-        for cloud_name, releases in clouds.items():
-            for release, stat_entry in releases.items():
-                yield from gen_metrics_from_stat_item(
-                    image_type, cloud_name, release, stat_entry)
+    for (image_type, cloud_name, release), stat_entry in stats.items():
+        yield from gen_metrics_from_stat_item(
+            image_type, cloud_name, release, stat_entry)
 
 
 def gen_metrics_from_stat_item(image_type, cloud_name, release, stat_entry):
@@ -198,56 +233,74 @@ def gen_metrics_from_stat_item(image_type, cloud_name, release, stat_entry):
     :param image_type: daily/release
     :param cloud_name: aws/azure/download, etc.
     :param release: artful/bionic, etc.
-    :param stat_entry: a release-level accumulated <stat_entry>,
-    that has 'by-machine' and 'by-arch' records, containing <stat_entry> under
-    respective keys.
+    :param stat_entry: a release-level ReleaseStatEntry, that has by_machine
+    and by_arch records, containing a StatEntry under respective keys.
     :return: InfluxDB metric generator
     """
     tags = dict(image_type=image_type, cloud=cloud_name, release=release)
 
-    for arch, stat in stat_entry['by-arch'].items():
+    for arch, stat in stat_entry.by_arch.items():
         yield _emit_metric(
             'published',
-            stat['count'],
+            stat.count,
             arch=arch,
             **tags
         )
 
     # Note: some machine-types can fail to publish, the oldest machine type
     # should be reported to help catch those occurences.
-    oldest_machine = max(stat_entry['by-machine'].values(),
-                         key=lambda i: i.get('age', 0))
-    if 'latest_serial' in oldest_machine:
+    oldest_machine = max(stat_entry.by_machine.values(),
+                         key=lambda i: i.age or 0)
+    if oldest_machine.latest_serial is not None:
         yield _emit_metric(
-            'current_serial', oldest_machine['latest_serial'], **tags)
+            'current_serial', oldest_machine.latest_serial, **tags)
         yield _emit_metric(
-            'current_serial_age', oldest_machine['age'], **tags)
+            'current_serial_age', oldest_machine.age, **tags)
 
-    if len(stat_entry['by-machine']) > 1:
-        for machine_type, stat in stat_entry['by-machine'].items():
-            if 'latest_serial' not in stat:
+    if len(stat_entry.by_machine) > 1:
+        for machine_type, stat in stat_entry.by_machine.items():
+            if stat.latest_serial is None:
                 continue
 
             tags['cloud'] = cloud_name + ':' + machine_type
 
-            yield _emit_metric('current_serial', stat['latest_serial'], **tags)
-            yield _emit_metric('current_serial_age', stat['age'], **tags)
+            yield _emit_metric('current_serial', stat.latest_serial, **tags)
+            yield _emit_metric('current_serial_age', stat.age, **tags)
+
+
+def get_interesting_images(item_filter, aws_item_filter):
+    """
+    Yield the simplestreams items of interest, in a single pass.
+
+    Every index and stream is read once. Each stream is routed by its
+    cloud: items of AWS streams must match aws_item_filter, items of all
+    other streams item_filter.
 
+    :param item_filter: a SimpleStreams filter for non-AWS image items
+    :param aws_item_filter: a SimpleStreams filter for AWS image items
+    """
+    aws_clouds = ifilter('cloudname ~ ^aws')
+    images = UbuntuCloudImages(streaming=True, prefetch=8)
+    for stream in images.get_product_streams(
+            item_filter=item_filter | aws_item_filter):
+        if aws_clouds.matches(stream.info):
+            yield from stream.get_product_items(aws_item_filter)
+        else:
+            yield from stream.get_product_items(item_filter)
 
-def collect_metrics(stream_filter, item_filter):
+
+def collect_metrics(images):
     """
     Generate metrics for images in ubuntu simplestreams.
 
-    Use UbuntuCloudImages to collect counts, latest_serial and it's age for
-    every permutation of image type, cloud name, release, arch and machine type
-    and create metric events for InfluxDB.
+    Collect counts, latest_serial and it's age for every permutation of
+    image type, cloud name, release, arch and machine type and create
+    metric events for InfluxDB.
 
-    :param stream_filter: a SimpleStreams filter for stream feeds
-    :param item_filter: a SimpleStreams filter for image items
+    :param images: simplestreams image items
     """
-    images = UbuntuCloudImages().get_product_items(stream_filter, item_filter)
     stats = parse_simplestreams_for_images(images)
-    return list(gen_metrics_from_stats(stats))
+    return gen_metrics_from_stats(stats)
 
 
 def filter_interesting_images():
@@ -273,21 +326,16 @@ def collect(dryrun=False):
     metrics = []
 
     interesting_images = filter_interesting_images()
-    aws_clouds = ifilter('cloudname ~ ^aws')
-    not_aws_clouds = -aws_clouds
-
-    print('Finding serials for non-aws clouds...')
-    metrics += collect_metrics(not_aws_clouds, interesting_images)
 
-    print('Finding serials for AWS clouds...')
+    print('Finding serials for clouds...')
     # These virt/storage combinations were present in early xenial development
     # dailies, but were dropped before release.
     aws_deprecated = (ifilter('release = xenial') &
                       ifilter('virt ~ ^(hvm|pv)$') &
                       ifilter('root_store ~ ^(io1|ebs)$'))
 
-    metrics += collect_metrics(aws_clouds,
-                               interesting_images & -aws_deprecated)
+    metrics.append(collect_metrics(get_interesting_images(
+        interesting_images, interesting_images & -aws_deprecated)))
 
     print('Finding serials for docker-core...')
     docker_core_serials = get_current_download_serials(DOCKER_CORE_ROOT)
@@ -297,16 +345,17 @@ def collect(dryrun=False):
             release, serial, age))
 
         tags = dict(image_type='daily', cloud='docker-core', release=release)
-        metrics += [
+        metrics.append([
             _emit_metric('current_serial', serial, **tags),
             _emit_metric('current_serial_age', age, **tags)
-        ]
+        ])
 
+    metrics = itertools.chain.from_iterable(metrics)
     if not dryrun:
         print('Pushing data...')
         util.influxdb_insert(metrics)
     else:
-        pprint.pprint(metrics)
+        pprint.pprint(list(metrics))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""Run collectors periodically from one long-lived process.
+
+Each collector module is imported once and its collect function is called
+on the interval given in a YAML config file, so interpreter start-up, the
+imports and the Launchpad login are paid once. The collectors share the
+process-wide HTTP session, HTTP cache and InfluxDB client. For example:
+
+    status_port: 8080
+    jobs:
+      - module: merges
+        args: [server]
+        interval: 3600
+      - module: foundations_errors
+        name: foundations_errors_ubuntu_server
+        args: [ubuntu-server]
+        interval: 86400
+
+args and kwargs are passed to collect. Runs are spread out by a random
+jitter and a job that is still running when it is due again is skipped.
+The status of every job is served as JSON on status_port.
+
+Copyright 2019 Canonical Ltd.
+"""
+import argparse
+import concurrent.futures
+from datetime import datetime
+import functools
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import importlib
+import json
+import random
+import signal
+import threading
+import time
+import traceback
+
+import yaml
+
+JITTER = 0.1
+'''fraction of a job's interval by which its runs are randomly moved'''
+WORKERS = 1
+STATUS_ADDRESS = '127.0.0.1'
+
+
+def _isoformat(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.utcfromtimestamp(timestamp).isoformat() + 'Z'
+
+
+class Job:
+    """A collector called periodically with fixed arguments."""
+
+    def __init__(self, name, collect, interval, args=None, kwargs=None):
+        """Construct the class."""
+        self.name = name
+        self.collect = functools.partial(collect, *(args or []),
+                                         **(kwargs or {}))
+        self.interval = interval
+        self.running = False
+        # spread out the first runs of all jobs started together
+        self.next_run = time.time() + random.uniform(0, JITTER * interval)
+        self.stats = {'runs': 0, 'failures': 0, 'skipped': 0,
+                      'last_start': None, 'last_duration': None,
+                      'last_error': None}
+
+    def schedule(self, now):
+        """Set the time of the next run, one jittered interval from now."""
+        self.next_run = now + self.interval * random.uniform(1 - JITTER,
+                                                             1 + JITTER)
+
+    def run(self):
+        """Call the collector, recording how it went."""
+        start = time.time()
+        error = None
+        try:
+            self.collect()
+        except SystemExit as exception:
+            # collectors exit on fatal errors, or with 0 when there is
+            # nothing to collect
+            if exception.code not in (None, 0):
+                error = 'exited with %s' % exception.code
+        except Exception:  # pylint: disable=broad-except
+            error = traceback.format_exc()
+
+        self.stats['runs'] += 1
+        self.stats['last_start'] = start
+        self.stats['last_duration'] = time.time() - start
+        self.stats['last_error'] = error
+        if error:
+            self.stats['failures'] += 1
+            print('%s failed: %s' % (self.name, error))
+        self.running = False
+
+    def status(self):
+        """Return a JSON-serializable status of the job."""
+        status = dict(self.stats)
+        status['last_start'] = _isoformat(status['last_start'])
+        status['next_run'] = _isoformat(self.next_run)
+        status['running'] = self.running
+        status['interval'] = self.interval
+        return status
+
+
+class Scheduler:
+    """Dispatch due jobs to a pool of worker threads."""
+
+    def __init__(self, jobs, workers=WORKERS):
+        """Construct the class."""
+        self.jobs = jobs
+        self.started = time.time()
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def _dispatch_due(self, now):
+        with self._lock:
+            for job in self.jobs:
+                if job.next_run > now:
+                    continue
+                job.schedule(now)
+                if job.running:
+                    job.stats['skipped'] += 1
+                    print('%s is still running, skipping this run' %
+                          job.name)
+                    continue
+                job.running = True
+                self._executor.submit(job.run)
+
+    def run_forever(self):
+        """Run jobs as they fall due, until stop is called."""
+        while not self._stopping.is_set():
+            now = time.time()
+            self._dispatch_due(now)
+            next_run = min(job.next_run for job in self.jobs)
+            self._stopping.wait(max(next_run - time.time(), 0))
+        self._executor.shutdown(wait=True)
+
+    def stop(self):
+        """Stop dispatching jobs; running jobs are allowed to finish."""
+        self._stopping.set()
+
+    def status(self):
+        """Return a JSON-serializable status of the scheduler."""
+        with self._lock:
+            return {
+                'started': _isoformat(self.started),
+                'jobs': {job.name: job.status() for job in self.jobs},
+            }
+
+
+def load_jobs(config):
+    """Import the collectors of the jobs in config and return Jobs."""
+    jobs = []
+    for entry in config['jobs']:
+        module = importlib.import_module('metrics.%s' % entry['module'])
+        jobs.append(Job(entry.get('name', entry['module']),
+                        module.collect,
+                        entry['interval'],
+                        entry.get('args'),
+                        entry.get('kwargs')))
+    return jobs
+
+
+def serve_status(scheduler, port, address=STATUS_ADDRESS):
+    """Serve the scheduler status as JSON from a background thread."""
+    class StatusHandler(BaseHTTPRequestHandler):
+        """Reply to every GET with the scheduler status."""
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """Send the status."""
+            body = json.dumps(scheduler.status(), indent=2).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            """Do not log every status request."""
+
+    server = HTTPServer((address, port), StatusHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='status-server', daemon=True)
+    thread.start()
+    return server
+
+
+def main(config_path):
+    """Run the jobs in the config file until terminated."""
+    with open(config_path) as config_file:
+        config = yaml.safe_load(config_file)
+
+    scheduler = Scheduler(load_jobs(config), config.get('workers', WORKERS))
+    if config.get('status_port'):
+        serve_status(scheduler, config['status_port'],
+                     config.get('status_address', STATUS_ADDRESS))
+
+    signal.signal(signal.SIGTERM, lambda *_: scheduler.stop())
+    try:
+        scheduler.run_forever()
+    except KeyboardInterrupt:
+        scheduler.stop()
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser()
+    PARSER.add_argument('config', help='YAML file listing the jobs to run')
+    ARGS = PARSER.parse_args()
+    main(ARGS.config)
@@ -5,8 +5,10 @@ Copyright 2018 Canonical Ltd.
 Joshua Powers <josh.powers@canonical.com>
 """
 import argparse
-import urllib.request
 
+import requests
+
+from metrics.helpers import fanout
 from metrics.helpers import util
 
 BASE_URL = 'https://hub.docker.com/v2/repositories/library'
@@ -16,15 +18,17 @@ DISTROS = ['ubuntu', 'busybox', 'centos', 'debian', 'alpine', 'fedora']
 def get_docker_data():
     """Get download for specific distro."""
     results = {}
-    for distro in DISTROS:
+    urls = ['%s/%s' % (BASE_URL, distro) for distro in DISTROS]
+    responses = fanout.fan_out(util.get_json_from_url, urls)
+    for distro, response in zip(DISTROS, responses):
         print('collecting data for %s' % distro)
-        try:
-            response = util.get_json_from_url('%s/%s' % (BASE_URL, distro))
-        except urllib.error.HTTPError:
+        if isinstance(response.error, requests.HTTPError):
             print('failed to get data for %s' % distro)
             continue
+        if response.error:
+            raise response.error
 
-        results[distro] = response['pull_count']
+        results[distro] = response.value['pull_count']
 
     return results
 
@@ -6,8 +6,8 @@ Copyright 2017 Canonical Ltd.
 Daniel Watkins <daniel.watkins@canonical.com>
 """
 import argparse
-import requests
 
+from metrics.helpers import fetch
 from metrics.helpers import util
 
 MEASUREMENT = 'docker_hub_images'
@@ -16,7 +16,7 @@ URL = 'https://hub.docker.com/v2/repositories/library/ubuntu/tags/'
 
 def _get_repository_dicts(url):
     """Iterate over Docker Hub responses to get all repositories."""
-    response = requests.get(url)
+    response = fetch.get_session().get(url)
     response.raise_for_status()
     body = response.json()
     for repository in body['results']:
@@ -51,10 +51,12 @@ def _get_data_points():
 
 def collect(dryrun=False):
     """Collect data and push to InfluxDB."""
-    data = list(_get_data_points())
+    data = _get_data_points()
     if not dryrun:
         print('Pushing data...')
-        util.influxdb_insert(data)
+        print('wrote {} datapoints'.format(util.influxdb_insert(data)))
+    else:
+        print('found {} datapoints'.format(len(list(data))))
 
 
 if __name__ == '__main__':
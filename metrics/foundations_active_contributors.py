@@ -6,10 +6,21 @@ Copyright 2017 Canonical Ltd.
 """
 
 import argparse
+from datetime import timezone
+import os
+import sqlite3
+
 import psycopg2
 
+from metrics.helpers import identities
 from metrics.helpers import lp
 from metrics.helpers import util
+from metrics.helpers.cachedir import get_cache_dir
+
+UPLOAD_WINDOW = '3 months'
+'''how far back uploads count towards active uploaders'''
+FETCH_BATCH = 1000
+'''upload history rows fetched from UDD per round trip'''
 
 
 def main_universe_uploader_count():
@@ -20,11 +31,9 @@ def main_universe_uploader_count():
     # for *all* archive upload rights (LP: #1705996 is needed).
     teams = ['ubuntu-core-dev', 'motu']
     uploaders = set()
-    for team in teams:
-        team = lp.LP.people[team]
-        for person in team.participants:
-            if person.is_valid and not person.is_team:
-                uploaders.add(person.name)
+    for person in lp.get_team_participants(teams).values():
+        if person['is_valid'] and not person['is_team']:
+            uploaders.add(person['name'])
 
     return len(uploaders)
 
@@ -43,59 +52,123 @@ def setup_udd_connection():
     return connection
 
 
-def try_guessing_by_email_mangling(email, user):
-    """Try guessing if non-Canonical email belongs to a Canonical user."""
+def mangled_emails(email, user):
+    """Return Canonical addresses a non-Canonical uploader may also have."""
     # If the uploader email address is an ubuntu.com one we can see if
     # they are a Canonical employee by checking to see if a matching
     # canonical.com email address is registered in Launchpad
+    emails = []
     if '@ubuntu.com' in email:
-        try_user = lp.get_person_by_email(
-            email.replace('@ubuntu.com', '@canonical.com'))
-        if try_user and try_user == user:
-            return True
+        emails.append(email.replace('@ubuntu.com', '@canonical.com'))
 
     # Another guess - let's try to take the display name and turn
     # it into a canonical e-mail.
-    try_email = ('%s@canonical.com'
-                 % user.display_name.replace(' ', '.'))
-    try_user = lp.get_person_by_email(try_email)
-    if try_user and try_user == user:
-        return True
+    emails.append('%s@canonical.com' % user.display_name.replace(' ', '.'))
+    return emails
 
-    return False
 
+def try_guessing_by_email_mangling(email, user, known):
+    """Try guessing if non-Canonical email belongs to a Canonical user."""
+    for try_email in mangled_emails(email, user):
+        try_user = known.get(try_email)
+        if try_user and try_user.self_link == user.self_link:
+            return True
 
-def per_affiliation_uploader_count():
-    """Return counts of recent Ubuntu uploaders per affiliation."""
-    cur = setup_udd_connection().cursor()
+    return False
 
+
+def _utc_isoformat(date):
+    """Return a timestamp from UDD as a string that sorts by time."""
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc)
+    return date.isoformat()
+
+
+def open_upload_history():
+    """Open the local store of recent UDD upload history."""
+    database = sqlite3.connect(os.path.join(get_cache_dir('udd'),
+                                            'upload_history.sqlite3'))
+    with database:
+        database.execute("""
+            create table if not exists uploads (
+                email text not null,
+                date text not null,
+                primary key (email, date)
+            )""")
+    return database
+
+
+def update_upload_history(database, connection):
+    """
+    Bring the local upload history up to date with UDD.
+
+    Only rows at or after the newest date already stored are fetched,
+    through a server-side cursor in batches of FETCH_BATCH. The boundary
+    rows fetched again are ignored as duplicates. Rows that fell out of
+    the UPLOAD_WINDOW, as measured by the UDD server's clock, are removed.
+    """
+    cur = connection.cursor()
+    cur.execute("select now() - %s::INTERVAL", (UPLOAD_WINDOW,))
+    cutoff = cur.fetchone()[0]
+    cur.close()
+
+    since = database.execute('select max(date) from uploads').fetchone()[0]
+    if since is None or since < _utc_isoformat(cutoff):
+        since = cutoff
+
+    cur = connection.cursor(name='ubuntu_upload_history')
     cur.execute("""
-        select changed_by_email
+        select changed_by_email, date
         from ubuntu_upload_history
-        where date >= (now() - '3 months'::INTERVAL)
+        where date >= %s
           and changed_by_name != ''
           and changed_by_email != 'archive@ubuntu.com'
           and changed_by_email != 'katie@jackass.ubuntu.com'
           and changed_by_email != 'language-packs@ubuntu.com'
-          and changed_by_email != 'N/A'
-        group by changed_by_email;
-""")
-    uploaders = cur.fetchall()
+          and changed_by_email != 'N/A';
+""", (since,))
+    with database:
+        rows = cur.fetchmany(FETCH_BATCH)
+        while rows:
+            database.executemany(
+                'insert or ignore into uploads values (?, ?)',
+                [(email, _utc_isoformat(date)) for email, date in rows])
+            rows = cur.fetchmany(FETCH_BATCH)
+        database.execute('delete from uploads where date < ?',
+                         (_utc_isoformat(cutoff),))
+    cur.close()
+
+
+def per_affiliation_uploader_count():
+    """Return counts of recent Ubuntu uploaders per affiliation."""
+    database = open_upload_history()
+    connection = setup_udd_connection()
+    update_upload_history(database, connection)
+    connection.close()
+    uploaders = [email for email, in database.execute(
+        'select distinct email from uploads order by email')]
+    database.close()
+
+    identity_cache = identities.get_identity_cache()
+    people = identity_cache.lookup(uploaders)
+    guesses = identity_cache.lookup(
+        try_email for uploader in uploaders
+        if people[uploader] and '@canonical.com' not in uploader
+        for try_email in mangled_emails(uploader, people[uploader]))
+    identity_cache.close()
 
     noncanonical = 0
     canonical = 0
     lp_usernames = set()
     canonical_usernames = set()
     for uploader in uploaders:
-        uploader = uploader[0]
-
         # Now, sadly, some ugly guesswork needs to happen.
         # The canonical team is private so we can't really check if a user is a
         # member of the team.  Also, because we're running as an anonymous user
         # we also have no access to the user's confirmed_email_addresses field,
         # so we can't even check if there's a canonical.com address in use.
         # In the current state of things all we can do is 'guess'
-        lp_person = lp.get_person_by_email(uploader)
+        lp_person = people[uploader]
         if not lp_person:
             # In case we can't find the user in LP for some reason, just guess
             # depending on the e-mail field - but this shouldn't really happen.
@@ -112,7 +185,8 @@ def per_affiliation_uploader_count():
         # Now we start guessing.  Those that we guess to be canonical end up in
         # the canonical_usernames bucket.
         if ('@canonical.com' in uploader or
-                try_guessing_by_email_mangling(uploader, lp_person)):
+                try_guessing_by_email_mangling(uploader, lp_person,
+                                               guesses)):
             canonical_usernames.add(lp_person.name)
 
     # Only after scanning all e-mail addresses we can definitely be sure how
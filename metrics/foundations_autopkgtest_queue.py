@@ -17,9 +17,11 @@ def get_queue_data():
     return queue_json
 
 
-def collect(queue_name, dryrun=False):
+def collect(queue_name, dryrun=False, queues_json=None):
     """Collect and push autopkgtest queue depth metrics."""
-    queue_details = QUEUES_JSON[queue_name]
+    if queues_json is None:
+        queues_json = get_queue_data()
+    queue_details = queues_json[queue_name]
 
     for release in queue_details:
         for arch in queue_details[release]:
@@ -64,4 +66,4 @@ if __name__ == '__main__':
             continue
         print("\n%s" % queue)
         print("-"*(len(queue)))
-        collect(queue, ARGS.dryrun)
+        collect(queue, ARGS.dryrun, QUEUES_JSON)
@@ -7,12 +7,12 @@ Brian Murray <brian@canonical.com>
 
 import argparse
 import sys
-import urllib.error
-import urllib.request
 
 from datetime import date, timedelta
-import simplejson as json
+import requests
 
+from metrics.helpers import fanout
+from metrics.helpers import fetch
 from metrics.helpers import lp
 from metrics.helpers import util
 
@@ -20,6 +20,13 @@ BASE_ERRORS_URL = 'https://errors.ubuntu.com/api/1.0'
 MCP_ERRORS_URL = BASE_ERRORS_URL + '/most-common-problems'
 
 
+def _get_top_ten_sum(mcp_url):
+    """Return the sum of the counts of the most common problems at a URL."""
+    response = fetch.get_session().get(mcp_url)
+    response.raise_for_status()
+    return sum(datum['count'] for datum in response.json()['objects'])
+
+
 def team_subscribed_mcp_count(team_name):
     """Query for the per release count of errors for team subbed pkgs."""
     # find the active releases
@@ -38,33 +45,21 @@ def team_subscribed_mcp_count(team_name):
     mcp_url += '&from=%s&to=%s' % (yesterday_str, yesterday_str)
 
     # query errors for no release, not quite a sum of every release because
-    # with limit 10 it could be 3 from Z, 2 from T, 5 from X.
-    try:
-        mcp_file = urllib.request.urlopen(mcp_url)
-    except urllib.error.HTTPError:
-        print('Timeout connecting to errors.ubuntu.com')
-        sys.exit(1)
-    mcp_data = json.load(mcp_file)
-    top_ten_sum = 0
-    for datum in mcp_data['objects']:
-        top_ten_sum += datum['count']
-    per_series['all_series'] = {}
-    per_series['all_series']['sum_top_ten_counts'] = top_ten_sum
-
-    # query for each active release
-    for series in active_series:
-        mcp_url += '&release=Ubuntu%%20%s' % series.version
-        try:
-            mcp_file = urllib.request.urlopen(mcp_url)
-        except urllib.error.HTTPError:
+    # with limit 10 it could be 3 from Z, 2 from T, 5 from X. Then query for
+    # each active release, all of them at once.
+    series_names = ['all_series'] + [s.name for s in active_series]
+    mcp_urls = [mcp_url] + ['%s&release=Ubuntu%%20%s' % (mcp_url, s.version)
+                            for s in active_series]
+    responses = fanout.fan_out(_get_top_ten_sum, mcp_urls)
+
+    for series_name, response in zip(series_names, responses):
+        if isinstance(response.error, requests.HTTPError):
             print('Timeout connecting to errors.ubuntu.com')
             sys.exit(1)
-        mcp_data = json.load(mcp_file)
-        per_series[series.name] = {}
-        top_ten_sum = 0
-        for datum in mcp_data['objects']:
-            top_ten_sum += datum['count']
-        per_series[series.name]['sum_top_ten_counts'] = top_ten_sum
+        if response.error:
+            raise response.error
+        per_series[series_name] = {}
+        per_series[series_name]['sum_top_ten_counts'] = response.value
 
     return per_series
 
@@ -73,7 +68,7 @@ def collect(team_name, dryrun=False):
     """Collect and push errors.u.c related metrics."""
     # check to see if its a vaild team LP team
     try:
-        lp.LP.people[team_name]
+        lp.get_person(team_name)
     except KeyError:
         print('Team %s does not exist in LP.' % team_name)
         return
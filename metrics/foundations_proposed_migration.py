@@ -4,8 +4,10 @@ import argparse
 import csv
 from io import StringIO
 import logging
-import urllib
 
+import requests
+
+from metrics.helpers import fetch
 from metrics.helpers import util
 
 
@@ -14,12 +16,12 @@ def get_proposed_migration_queue(data):
     src = 'https://people.canonical.com/~ubuntu-archive/proposed-migration/' \
           + 'update_excuses.csv'
     logging.info('Pulling proposed-migration stats')
-    with urllib.request.urlopen(src) as req:
-        code = req.getcode()
-        if code != 200:
-            logging.error('URL %s failed with code %u', req.geturl(), code)
-            return
-        csvdata = StringIO(req.read().decode('UTF-8'))
+    try:
+        csvdata = StringIO(fetch.get_text(src))
+    except requests.HTTPError as exception:
+        logging.error('URL %s failed with code %u', src,
+                      exception.response.status_code)
+        return
 
     csv_handle = csv.reader(csvdata)
     latest = list(csv_handle)[-1]
@@ -40,22 +42,26 @@ def get_proposed_migration_queue(data):
     })
 
 
-if __name__ == '__main__':
-    PARSER = argparse.ArgumentParser()
-    PARSER.add_argument('--dryrun', action='store_true')
-    ARGS = PARSER.parse_args()
-    logging.basicConfig(level=logging.DEBUG)
-
-    DATA = []
+def collect(dryrun=False):
+    """Collect and push proposed-migration metrics."""
+    data = []
     try:
-        get_proposed_migration_queue(DATA)
+        get_proposed_migration_queue(data)
     finally:
-        if ARGS.dryrun:
+        if dryrun:
             print('Valid candidates: %i' %
-                  DATA[0]['fields']['valid_candidates'])
+                  data[0]['fields']['valid_candidates'])
             print('Not considered candidates: %i' %
-                  DATA[0]['fields']['not_considered'])
-            print('Median age: %i' % DATA[0]['fields']['median_age'])
-            print('Backlog: %i' % DATA[0]['fields']['backlog'])
+                  data[0]['fields']['not_considered'])
+            print('Median age: %i' % data[0]['fields']['median_age'])
+            print('Backlog: %i' % data[0]['fields']['backlog'])
         else:
-            util.influxdb_insert(DATA)
+            util.influxdb_insert(data)
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser()
+    PARSER.add_argument('--dryrun', action='store_true')
+    ARGS = PARSER.parse_args()
+    logging.basicConfig(level=logging.DEBUG)
+    collect(ARGS.dryrun)
@@ -3,9 +3,11 @@
 import argparse
 from io import StringIO
 import logging
-import urllib
+
+import requests
 import yaml
 
+from metrics.helpers import fetch
 from metrics.helpers import util
 
 
@@ -14,12 +16,12 @@ def get_proposed_migration_queue(team):
     src = 'https://people.canonical.com/~ubuntu-archive/proposed-migration/' \
           + 'update_excuses_by_team.yaml'
     logging.info('Pulling proposed-migration stats')
-    with urllib.request.urlopen(src) as req:
-        code = req.getcode()
-        if code != 200:
-            logging.error('URL %s failed with code %u', req.geturl(), code)
-            return {}
-        yamldata = StringIO(req.read().decode('UTF-8'))
+    try:
+        yamldata = StringIO(fetch.get_text(src))
+    except requests.HTTPError as exception:
+        logging.error('URL %s failed with code %u', src,
+                      exception.response.status_code)
+        return {}
     yaml_handle = yaml.load(yamldata, Loader=yaml.Loader)
     valid = 0
     not_considered = 0
@@ -57,22 +59,25 @@ def get_proposed_migration_queue(team):
     return metric
 
 
+def collect(team, dryrun=False):
+    """Collect and push proposed-migration metrics for a team."""
+    data = get_proposed_migration_queue(team)
+
+    if not dryrun:
+        print('Pushing data...')
+        util.influxdb_insert([data])
+    else:
+        print('Valid candidates: %i' % data['fields']['valid_candidates'])
+        print('Not considered candidates: %i' %
+              data['fields']['not_considered'])
+        print('Median age: %i' % data['fields']['median_age'])
+        print('Backlog: %i' % data['fields']['backlog'])
+
+
 if __name__ == '__main__':
     PARSER = argparse.ArgumentParser()
     PARSER.add_argument('--dryrun', action='store_true')
     PARSER.add_argument('--team', help='team_name')
     ARGS = PARSER.parse_args()
     logging.basicConfig(level=logging.DEBUG)
-
-    TEAM = ARGS.team
-    DATA = get_proposed_migration_queue(TEAM)
-
-    if not ARGS.dryrun:
-        print('Pushing data...')
-        util.influxdb_insert([DATA])
-    else:
-        print('Valid candidates: %i' % DATA['fields']['valid_candidates'])
-        print('Not considered candidates: %i' %
-              DATA['fields']['not_considered'])
-        print('Median age: %i' % DATA['fields']['median_age'])
-        print('Backlog: %i' % DATA['fields']['backlog'])
+    collect(ARGS.team, ARGS.dryrun)
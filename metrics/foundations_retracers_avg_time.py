@@ -13,7 +13,6 @@ from datetime import date, datetime, timedelta
 from metrics.helpers import util
 
 BASE_ERRORS_URL = 'https://errors.ubuntu.com/api/1.0'
-YESTERDAY = date.today() - timedelta(days=1)
 
 
 def get_rtime_data(base_errors_url):
@@ -31,11 +30,12 @@ def collect(environment, dryrun=False):
     if environment == 'staging':
         base_errors_url = base_errors_url.replace('errors.', 'errors.staging.')
     retrace_time_json = get_rtime_data(base_errors_url)
+    yesterday = date.today() - timedelta(days=1)
 
     if len(retrace_time_json['objects']) == 0:
         print("No retracing has occurred")
         sys.exit(1)
-    if retrace_time_json['objects'][0]['date'] != YESTERDAY.strftime('%Y%m%d'):
+    if retrace_time_json['objects'][0]['date'] != yesterday.strftime('%Y%m%d'):
         print("The results are not for today, quitting.")
         sys.exit(0)
 
@@ -50,7 +50,7 @@ def collect(environment, dryrun=False):
             data.append({
                 # we don't need per minute counts of results
                 'time':
-                    datetime(YESTERDAY.year, YESTERDAY.month, YESTERDAY.day),
+                    datetime(yesterday.year, yesterday.month, yesterday.day),
                 'measurement': 'foundations_%s_retracers_avg_time' %
                                environment,
                 'fields': {
@@ -13,7 +13,6 @@ from datetime import date, datetime
 from metrics.helpers import util
 
 BASE_ERRORS_URL = 'https://errors.ubuntu.com/api/1.0'
-TODAY = date.today()
 
 
 def get_rresults_data(base_errors_url):
@@ -30,11 +29,12 @@ def collect(environment, dryrun=False):
     if environment == 'staging':
         base_errors_url = base_errors_url.replace('errors.', 'errors.staging.')
     retrace_results_json = get_rresults_data(base_errors_url)
+    today = date.today()
 
     if len(retrace_results_json['objects']) == 0:
         print("No retracing has occurred")
         sys.exit(1)
-    if retrace_results_json['objects'][0]['date'] != TODAY.strftime('%Y%m%d'):
+    if retrace_results_json['objects'][0]['date'] != today.strftime('%Y%m%d'):
         print("The results are not for today, quitting.")
         sys.exit(0)
 
@@ -59,7 +59,7 @@ def collect(environment, dryrun=False):
                 continue
             data.append({
                 # we don't need per minute counts of results
-                'time': datetime(TODAY.year, TODAY.month, TODAY.day),
+                'time': datetime(today.year, today.month, today.day),
                 'measurement': 'foundations_%s_retracers_results' %
                                environment,
                 'fields': {
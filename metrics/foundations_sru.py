@@ -6,109 +6,210 @@ Copyright 2017 Canonical Ltd.
 """
 
 import argparse
-import logging
-import urllib.request
-
+from collections import deque, namedtuple, OrderedDict
 from datetime import datetime
-from bs4 import BeautifulSoup
-
-try:
-    from html.parser import HTMLParseError
-except ImportError as exception:
-    # Taken from bs4 code.
-    class HTMLParseError(Exception):
-        """Dummy exception."""
-
+from html.parser import HTMLParser
+import io
+from urllib.parse import urlencode
 
+from metrics.helpers import fetch
 from metrics.helpers import lp
 from metrics.helpers import util
 
-
-def sru_queue_count():
-    """Get the number of UNAPPROVED uploads for proposed for each series."""
+PENDING_SRU_URL = \
+    'http://people.canonical.com/~ubuntu-archive/pending-sru.html'
+
+SRURow = namedtuple('SRURow', ['package', 'failure', 'age_in_days', 'bugs'])
+'''A package in -proposed: its failure text, age and the classes of each
+of its bugs'''
+
+
+class _PendingSRUParser(HTMLParser):
+    """Collect the package rows of each release table of the report."""
+
+    _TAG = object()
+    '''stands in for a start tag in the preceding nodes'''
+    _SKIPPED_TABLES = ('Upload queue status at a glance:',)
+
+    def __init__(self):
+        """Construct the class."""
+        super().__init__()
+        self.tables = OrderedDict()
+        # the last two tags and strings in document order, to find the
+        # release name of a table like bs4's table.previous.previous
+        self._previous = deque(maxlen=2)
+        # whether the last string is still open: text is handed over in
+        # pieces wherever a fed chunk ends, and only a tag ends a string
+        self._in_text = False
+        self._rows = None
+        self._cells = None
+        self._in_link = False
+
+    def _end_row(self):
+        cells, self._cells = self._cells, None
+        if not cells:
+            return
+        package = cells[0]['link']
+        self._rows[package] = SRURow(
+            package,
+            ''.join(cells[0]['text']).replace(package, '').strip(),
+            int(''.join(cells[5]['text'])),
+            tuple(cells[4]['bugs']))
+
+    def handle_starttag(self, tag, attrs):
+        """Start a release table, row, cell or bug link."""
+        if tag == 'table' and self._rows is None:
+            release = self._previous[0] if self._previous else None
+            if ('id' in dict(attrs) and isinstance(release, str) and
+                    release not in self._SKIPPED_TABLES):
+                self._rows = self.tables[release] = OrderedDict()
+        elif self._rows is not None:
+            if tag == 'tr':
+                self._end_row()
+                self._cells = []
+            elif tag == 'td' and self._cells is not None:
+                self._cells.append({'text': [], 'link': None, 'bugs': []})
+            elif tag == 'a' and self._cells:
+                cell = self._cells[-1]
+                if cell['link'] is None:
+                    cell['link'] = ''
+                    self._in_link = True
+                cell['bugs'].append(
+                    tuple((dict(attrs).get('class') or '').split()))
+        self._previous.append(self._TAG)
+        self._in_text = False
+
+    def handle_endtag(self, tag):
+        """End a link, row or release table."""
+        self._in_text = False
+        if tag == 'a':
+            self._in_link = False
+        elif tag == 'tr' and self._rows is not None:
+            self._end_row()
+        elif tag == 'table' and self._rows is not None:
+            self._end_row()
+            self._rows = None
+
+    def handle_data(self, data):
+        """Collect the text of cells and of their first link."""
+        if self._cells:
+            cell = self._cells[-1]
+            cell['text'].append(data)
+            if self._in_link:
+                cell['link'] += data
+        if self._in_text:
+            self._previous[-1] += data
+        else:
+            self._previous.append(data)
+            self._in_text = True
+
+
+class PendingSRUReport:  # pylint: disable=too-few-public-methods
+    """The pending-sru report, parsed into package rows per release."""
+
+    def __init__(self, tables):
+        """
+        Construct the class.
+
+        @param tables: dict mapping release names to lists of SRURow
+        """
+        self.tables = tables
+
+    @classmethod
+    def fetch(cls, url=PENDING_SRU_URL, chunk_size=fetch.CHUNK_SIZE):
+        """Download and parse the report in a single streaming pass."""
+        with io.TextIOWrapper(fetch.open_url(url), encoding='utf-8',
+                              errors='replace') as report:
+            return cls.parse(iter(lambda: report.read(chunk_size), ''))
+
+    @classmethod
+    def parse(cls, chunks):
+        """
+        Parse the report from the pieces of its text.
+
+        The result does not depend on where the text is split.
+
+        @param chunks: iterable of str
+        """
+        parser = _PendingSRUParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.close()
+        return cls(OrderedDict((release, list(rows.values()))
+                               for release, rows in parser.tables.items()))
+
+
+def _unapproved_stats(dates_created, today):
+    """Count and age UNAPPROVED uploads, given their creation dates."""
+    count = 0
+    oldest_age_in_days = 0
+    backlog_age = 0
+    backlog_count = 0
+    for date_created in dates_created:
+        count += 1
+        # the granularity only needs to be in days so tzinfo doesn't need
+        # to be accurate
+        age_in_days = (today - datetime.strptime(
+            date_created[:19], '%Y-%m-%dT%H:%M:%S')).days
+        oldest_age_in_days = max(oldest_age_in_days, age_in_days)
+        # items in the queue for > 10 days have gone through at least a
+        # weeks worth of reviewers and should be considered late
+        if age_in_days > 10:
+            backlog_age += age_in_days - 10
+            backlog_count += 1
+
+    return {
+        'count': count,
+        'oldest_age_in_days': oldest_age_in_days,
+        'ten_day_backlog_count': backlog_count,
+        'ten_day_backlog_age': backlog_age,
+    }
+
+
+def unapproved_sru_stats():
+    """
+    Count and age UNAPPROVED uploads for proposed for each series.
+
+    The upload queue of every active stable series is read once, as raw
+    JSON through the shared HTTP session, and the queues of all series
+    are paged concurrently.
+    """
     ubuntu = lp.get_ubuntu()
-    stable_series = [s for s in ubuntu.series if s.active]
-    stable_series.remove(ubuntu.current_series)
+    devel = ubuntu.current_series_link.split('/')[-1]
+    query = urlencode({'ws.op': 'getPackageUploads', 'status': 'Unapproved',
+                       'pocket': 'Proposed'})
+    queues = {'%s?%s' % (series.self_link, query): series.name
+              for series in ubuntu.series
+              if series.active and series.name != devel}
 
-    per_series = {}
-    for series in stable_series:
-        per_series[series.name] = len(series.getPackageUploads(
-            status='Unapproved',
-            pocket='Proposed'))
-
-    return per_series
+    dates_created = {name: [] for name in queues.values()}
+    for url, upload in lp.iter_raw_entries(queues):
+        dates_created[queues[url]].append(upload['date_created'])
 
-
-def unapproved_sru_ages():
-    """Determine age of UNAPPROVED uploads for proposed for each series."""
-    ubuntu = lp.get_ubuntu()
-    stable_series = [s for s in ubuntu.series if s.active]
-    stable_series.remove(ubuntu.current_series)
-
-    per_series = {}
-    for series in stable_series:
-        uploads = series.getPackageUploads(status='Unapproved',
-                                           pocket='Proposed')
-        oldest_age_in_days = 0
-        backlog_age = 0
-        backlog_count = 0
-        today = datetime.today()
-        for upload in uploads:
-            # the granularity only needs to be in days so tzinfo doesn't need
-            # to be accurate
-            age_in_days = (today -
-                           upload.date_created.replace(tzinfo=None)).days
-            if age_in_days > oldest_age_in_days:
-                oldest_age_in_days = age_in_days
-            # items in the queue for > 10 days have gone through at least a
-            # weeks worth of reviewers and should be considered late
-            if age_in_days > 10:
-                backlog_age += age_in_days - 10
-                backlog_count += 1
-        per_series[series.name] = {}
-        per_series[series.name]['oldest_age_in_days'] = oldest_age_in_days
-        per_series[series.name]['ten_day_backlog_count'] = backlog_count
-        per_series[series.name]['ten_day_backlog_age'] = backlog_age
-
-    return per_series
+    today = datetime.today()
+    return {name: _unapproved_stats(dates, today)
+            for name, dates in dates_created.items()}
 
 
-def sru_verified_and_ready_count():
+def sru_verified_and_ready_count(report):
     """Get the number -proposed packages that are verified and good to go."""
     # Most of this code is taken from lp:~brian-murray/+junk/bug-agent, just
     # modified to do what we want.
-    url = 'http://people.canonical.com/~ubuntu-archive/pending-sru.html'
-    report_contents = urllib.request.urlopen(url).read()
-    try:
-        soup = BeautifulSoup(report_contents, 'lxml')
-    except HTMLParseError:
-        logging.error('Error parsing SRU report')
-        raise
-
     ready_srus = {}
-    tables = soup.findAll('table')
-    for table in tables:
-        if not table.has_attr('id'):
-            continue
-
-        release = table.previous.previous
-        if release == 'Upload queue status at a glance:':
-            continue
-
+    for release, rows in report.tables.items():
         ready_srus[release] = 0
-        tdata = parse_table_rows(table)
-        for pkg in tdata:
-            failure = tdata[pkg]['failure']
+        for row in rows:
+            failure = row.failure
             if ('Failed' in failure or
                     'Dependency wait' in failure or
                     'Cancelled' in failure or
                     'Regression in autopkgtest' in failure):
                 continue
-            if tdata[pkg]['age_in_days'] < 7:
+            if row.age_in_days < 7:
                 continue
             verified = True
-            for bug in tdata[pkg]['bugs']:
-                if 'verified' not in bug['class']:
+            for bug_class in row.bugs:
+                if 'verified' not in bug_class:
                     verified = False
                     break
             if verified:
@@ -117,7 +218,7 @@ def sru_verified_and_ready_count():
     return ready_srus
 
 
-def count_packages(per_series, release, table):
+def count_packages(per_series, release, rows):
     """Categorize and determine age of packages in -proposed."""
     unverified_backlog_count = 0
     unverified_backlog_age = 0
@@ -125,10 +226,9 @@ def count_packages(per_series, release, table):
     verified_backlog_age = 0
     vfailed_backlog_count = 0
     vfailed_backlog_age = 0
-    tdata = parse_table_rows(table)
-    for pkg in tdata:
-        failure = tdata[pkg]['failure']
-        age_in_days = tdata[pkg]['age_in_days']
+    for row in rows:
+        failure = row.failure
+        age_in_days = row.age_in_days
         # give the SRU 14 days to be verified
         if age_in_days <= 14:
             continue
@@ -139,15 +239,15 @@ def count_packages(per_series, release, table):
                 'Cancelled' in failure or
                 'Regression in autopkgtest' in failure):
             category = 'unverified'
-        for bug in tdata[pkg]['bugs']:
+        for bug_class in row.bugs:
             # vfailed will overwrite the unverified status of an SRU
-            if 'verificationfailed' in bug['class']:
+            if 'verificationfailed' in bug_class:
                 category = 'vfailed'
                 break
-            if 'verified' not in bug['class']:
+            if 'verified' not in bug_class:
                 category = 'unverified'
                 break
-            if 'verified' in bug['class']:
+            if 'verified' in bug_class:
                 # if it is unverified for any reason then it can't be
                 # verified i.e. every bug needs verification
                 if category != 'unverified':
@@ -177,52 +277,12 @@ def count_packages(per_series, release, table):
         vfailed_backlog_age
 
 
-def parse_table_rows(bs4_table):
-    """Parse tables from the pending-sru report."""
-    # return a dict of the used table rows
-    # {package: {'failure': cols[0]text,
-    #            'age_in_days': int(cols[5].string,
-    #            'bugs': html of bugs
-    # }
-    data = {}
-    table_rows = bs4_table.findAll('tr')
-    for table_row in table_rows:
-        table_data = table_row.findAll('td')
-        length = len(table_data)
-        if length == 0:
-            continue
-        package = table_data[0].find('a').text
-        data[package] = {}
-        data[package]['failure'] = \
-            table_data[0].text.replace(package, '').strip()
-        data[package]['age_in_days'] = int(table_data[5].string)
-        bugs = table_data[4].findChildren('a')
-        data[package]['bugs'] = bugs
-    return data
-
-
-def proposed_package_ages():
+def proposed_package_ages(report):
     """Return per series type and age of packages in -proposed."""
-    url = 'http://people.canonical.com/~ubuntu-archive/pending-sru.html'
-    report_contents = urllib.request.urlopen(url).read()
-    try:
-        soup = BeautifulSoup(report_contents, 'lxml')
-    except HTMLParseError:
-        logging.error('Error parsing SRU report')
-        raise
-
     per_series = {}
-    tables = soup.findAll('table')
-    for table in tables:
-        if not table.has_attr('id'):
-            continue
-
-        release = table.previous.previous
-        if release == 'Upload queue status at a glance:':
-            continue
-
+    for release, rows in report.tables.items():
         per_series[release] = {}
-        count_packages(per_series, release, table)
+        count_packages(per_series, release, rows)
 
     return per_series
 
@@ -230,10 +290,12 @@ def proposed_package_ages():
 def collect(dryrun=False):  # pylint: disable=too-many-branches
     """Collect and push SRU-related metrics."""
     data = []
-    sru_queues = sru_queue_count()
-    ready_srus = sru_verified_and_ready_count()
-    proposed_sru_age_data = proposed_package_ages()
-    unapproved_sru_age_data = unapproved_sru_ages()
+    unapproved_sru_age_data = unapproved_sru_stats()
+    sru_queues = {series: stats['count']
+                  for series, stats in unapproved_sru_age_data.items()}
+    report = PendingSRUReport.fetch()
+    ready_srus = sru_verified_and_ready_count(report)
+    proposed_sru_age_data = proposed_package_ages(report)
 
     q_name = 'Proposed Uploads in the Unapproved Queue per Series'
 
@@ -0,0 +1,23 @@
+"""Location of data kept between runs.
+
+Copyright 2019 Canonical Ltd.
+"""
+import os
+
+
+def get_cache_dir(*parts):
+    """
+    Return a directory for data kept between runs, creating it if needed.
+
+    The base directory is $METRICS_CACHE_DIR, or metrics/ under
+    $XDG_CACHE_HOME (~/.cache by default).
+    """
+    base = os.environ.get('METRICS_CACHE_DIR')
+    if not base:
+        base = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or
+            os.path.expanduser('~/.cache'), 'metrics')
+
+    path = os.path.join(base, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
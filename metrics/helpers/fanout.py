@@ -0,0 +1,116 @@
+"""Run independent calls concurrently with bounded parallelism.
+
+Copyright 2019 Canonical Ltd.
+"""
+from collections import deque, namedtuple
+import concurrent.futures
+from itertools import islice
+import time
+
+MAX_WORKERS = 8
+POLL_INTERVAL = 0.1
+
+Result = namedtuple('Result', ['item', 'value', 'error'])
+'''Outcome of one call: its input item, return value and exception if any'''
+
+
+def _wait(future, started, index, timeout):
+    """Return the result of future, allowing it timeout seconds once run."""
+    if timeout is None:
+        return future.result()
+
+    while True:
+        if future.done():
+            # however late it is waited on, a finished call is not timed out
+            return future.result()
+        start = started.get(index)
+        if start is None:
+            # still queued behind other calls, its clock has not started
+            wait = POLL_INTERVAL
+        else:
+            wait = start + timeout - time.monotonic()
+            if wait <= 0:
+                raise TimeoutError('call exceeded %ss timeout' % timeout)
+        try:
+            return future.result(timeout=wait)
+        except concurrent.futures.TimeoutError:
+            if future.done():
+                # raised by the call itself
+                raise
+
+
+def fan_out(func, items, max_workers=MAX_WORKERS, timeout=None):
+    """
+    Call func on every item concurrently, returning results in input order.
+
+    At most max_workers calls run at once. A call that raises does not
+    abort the others; its exception is returned in the error field of its
+    Result. A call still running timeout seconds after it started is
+    reported with a TimeoutError and left to finish in the background.
+
+    :param func: callable taking a single item
+    :param items: iterable of items
+    :param max_workers: maximum number of concurrent calls
+    :param timeout: optional number of seconds each call may take
+    :return: list of Result, one per item, in the order of items
+    """
+    items = list(items)
+    started = {}
+
+    def call(index, item):
+        started[index] = time.monotonic()
+        return func(item)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [executor.submit(call, index, item)
+                   for index, item in enumerate(items)]
+        results = []
+        for index, (item, future) in enumerate(zip(items, futures)):
+            try:
+                value = _wait(future, started, index, timeout)
+            except Exception as error:  # pylint: disable=broad-except
+                results.append(Result(item, None, error))
+            else:
+                results.append(Result(item, value, None))
+    finally:
+        # do not block on calls that timed out
+        executor.shutdown(wait=False)
+
+    return results
+
+
+def iter_fan_out(func, items, max_workers=MAX_WORKERS):
+    """
+    Call func on items concurrently, yielding results in input order.
+
+    Unlike fan_out this is lazy: items are taken from the iterable only as
+    workers become free, at most max_workers calls are pending at a time,
+    and each Result is yielded as soon as it and all before it are done.
+    Work still pending when the generator is closed is cancelled.
+
+    :param func: callable taking a single item
+    :param items: iterable of items, consumed in the calling thread
+    :param max_workers: maximum number of pending calls
+    :return: generator of Result, one per item, in the order of items
+    """
+    items = iter(items)
+    pending = deque()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for item in islice(items, max_workers):
+            pending.append((item, executor.submit(func, item)))
+
+        while pending:
+            item, future = pending.popleft()
+            try:
+                result = Result(item, future.result(), None)
+            except Exception as error:  # pylint: disable=broad-except
+                result = Result(item, None, error)
+            for next_item in islice(items, 1):
+                pending.append((next_item, executor.submit(func, next_item)))
+            yield result
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
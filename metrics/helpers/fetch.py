@@ -0,0 +1,219 @@
+"""Fetch upstream URLs through a shared session and on-disk HTTP cache.
+
+All HTTP traffic goes through one requests session, which keeps a pool of
+keep-alive connections per host, applies default timeouts and handles gzip
+transfer encoding transparently.
+
+Responses are cached by URL. A cached response younger than the caller's
+TTL is used as is, anything older is revalidated with If-None-Match and
+If-Modified-Since so that an unchanged source costs a 304 rather than a
+full download. The cache is bounded in size and evicts the least recently
+used responses first.
+
+Copyright 2019 Canonical Ltd.
+"""
+import atexit
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics.helpers.cachedir import get_cache_dir
+
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+POOL_HOSTS = 32
+POOL_CONNECTIONS_PER_HOST = 10
+TIMEOUT = (10, 120)
+'''(connect, read) timeout in seconds for requests that do not set one'''
+
+_CACHE = None
+_SESSION = None
+_LOCK = threading.Lock()
+
+
+class _Session(requests.Session):
+    """A requests session with a default timeout."""
+
+    # pylint: disable=arguments-differ
+    def request(self, method, url, **kwargs):
+        """Send a request, with the default timeout unless one is given."""
+        kwargs.setdefault('timeout', TIMEOUT)
+        return super().request(method, url, **kwargs)
+
+
+def get_session():
+    """
+    Return the process-wide requests session.
+
+    Up to POOL_CONNECTIONS_PER_HOST connections per host are kept alive
+    and reused. Threads beyond that wait for a free connection instead of
+    opening more.
+    """
+    global _SESSION  # pylint: disable=global-statement
+
+    with _LOCK:
+        if _SESSION is None:
+            _SESSION = _Session()
+            adapter = HTTPAdapter(pool_connections=POOL_HOSTS,
+                                  pool_maxsize=POOL_CONNECTIONS_PER_HOST,
+                                  pool_block=True)
+            _SESSION.mount('http://', adapter)
+            _SESSION.mount('https://', adapter)
+            atexit.register(_SESSION.close)
+
+    return _SESSION
+
+
+class HTTPCache:
+    """A size-bounded, revalidating cache of HTTP responses."""
+
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        """Construct the class."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = {'hit': 0, 'revalidated': 0, 'miss': 0}
+        self._lock = threading.Lock()
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        path = os.path.join(self.directory, key)
+        return path + '.body', path + '.json'
+
+    def _count(self, outcome):
+        with self._lock:
+            self.stats[outcome] += 1
+
+    @staticmethod
+    def _load_meta(meta_path):
+        try:
+            with open(meta_path) as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_atomically(self, path, chunks):
+        """Write an iterable of bytes to path, replacing it atomically."""
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as tmp_file:
+                for chunk in chunks:
+                    tmp_file.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _store(self, url, response, body_path, meta_path):
+        self._write_atomically(body_path, response.iter_content(CHUNK_SIZE))
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched': time.time(),
+        }
+        with tempfile.NamedTemporaryFile('w', dir=self.directory,
+                                         delete=False) as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(meta_file.name, meta_path)
+
+    def _evict(self):
+        """Remove least recently used responses until under max_bytes."""
+        bodies = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.body'):
+                stat = entry.stat()
+                bodies.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        for _, size, path in sorted(bodies):
+            if total <= self.max_bytes:
+                break
+            for stale in (path, path[:-len('.body')] + '.json'):
+                try:
+                    os.unlink(stale)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+    def refresh(self, url, ttl=0):
+        """
+        Make sure the cached response for url is usable and return its path.
+
+        :param url: URL to fetch
+        :param ttl: seconds for which a cached response is used without
+            revalidating it
+        :raises requests.HTTPError: if the server returns an error
+        """
+        body_path, meta_path = self._paths(url)
+        meta = self._load_meta(meta_path)
+        if meta is not None and not os.path.exists(body_path):
+            meta = None
+
+        if meta is not None and time.time() - meta['fetched'] < ttl:
+            self._count('hit')
+            os.utime(body_path)
+            return body_path
+
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        with get_session().get(url, headers=headers, stream=True) as response:
+            if response.status_code == 304 and meta is not None:
+                self._count('revalidated')
+                meta['fetched'] = time.time()
+                with open(meta_path, 'w') as meta_file:
+                    json.dump(meta, meta_file)
+                os.utime(body_path)
+                return body_path
+
+            response.raise_for_status()
+            self._store(url, response, body_path, meta_path)
+
+        self._count('miss')
+        self._evict()
+        return body_path
+
+    def report(self):
+        """Print the cache hit and miss counts, if it has been used."""
+        if any(self.stats.values()):
+            print('HTTP cache: %(hit)s hits, %(revalidated)s revalidated, '
+                  '%(miss)s misses' % self.stats)
+
+
+def get_cache():
+    """Return the process-wide HTTP cache."""
+    global _CACHE  # pylint: disable=global-statement
+
+    with _LOCK:
+        if _CACHE is None:
+            _CACHE = HTTPCache(get_cache_dir('http'))
+            atexit.register(_CACHE.report)
+
+    return _CACHE
+
+
+def open_url(url, ttl=0):
+    """Return a binary file object with the (cached) body of url."""
+    return open(get_cache().refresh(url, ttl), 'rb')
+
+
+def get(url, ttl=0):
+    """Return the (cached) body of url as bytes."""
+    with open_url(url, ttl) as body:
+        return body.read()
+
+
+def get_text(url, ttl=0, encoding='utf-8'):
+    """Return the (cached) body of url decoded to text."""
+    return get(url, ttl).decode(encoding)
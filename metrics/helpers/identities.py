@@ -0,0 +1,120 @@
+"""Persistent cache of the Launchpad identities of email addresses.
+
+Looking up a person by email is one Launchpad request per address, while
+the set of addresses asked about changes little between runs. Answers are
+kept in an SQLite database in the cache directory, including negative ones
+for addresses that are not registered in Launchpad, each with its own
+expiry. Only new and expired addresses are looked up again, concurrently.
+
+Copyright 2019 Canonical Ltd.
+"""
+from collections import namedtuple
+import os
+import sqlite3
+import time
+
+from metrics.helpers import fanout
+from metrics.helpers import lp
+from metrics.helpers.cachedir import get_cache_dir
+
+TTL = 7 * 24 * 3600
+'''seconds for which the person an address belongs to is trusted'''
+NEGATIVE_TTL = 24 * 3600
+'''seconds for which an address is trusted to be unknown to Launchpad'''
+QUERY_CHUNK = 500
+'''addresses per query, within SQLite's limit on query parameters'''
+
+Identity = namedtuple('Identity', ['self_link', 'name', 'display_name'])
+'''The Launchpad person an email address belongs to'''
+
+
+def resolve_email(email):
+    """Return the Identity of email from Launchpad, or None if unknown."""
+    person = lp.get_person_by_email(email)
+    if not person:
+        return None
+    return Identity(person.self_link, person.name, person.display_name)
+
+
+class IdentityCache:
+    """An SQLite cache of the Identity of email addresses."""
+
+    def __init__(self, path, ttl=TTL, negative_ttl=NEGATIVE_TTL):
+        """Construct the class."""
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stats = {'hit': 0, 'miss': 0}
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.execute("""
+                create table if not exists identities (
+                    email text primary key,
+                    self_link text,
+                    name text,
+                    display_name text,
+                    expires real not null
+                )""")
+
+    def _cached(self, emails, now):
+        """Return the unexpired cached answers for emails."""
+        emails = list(emails)
+        cached = {}
+        for start in range(0, len(emails), QUERY_CHUNK):
+            chunk = emails[start:start + QUERY_CHUNK]
+            rows = self._db.execute(
+                'select email, self_link, name, display_name from identities'
+                ' where expires > ? and email in (%s)' %
+                ','.join('?' * len(chunk)), [now] + chunk)
+            for email, self_link, name, display_name in rows:
+                if self_link is None:
+                    cached[email] = None
+                else:
+                    cached[email] = Identity(self_link, name, display_name)
+        return cached
+
+    def lookup(self, emails, resolve=resolve_email):
+        """
+        Return the Identity of each email, or None if it is unknown.
+
+        Addresses that are not cached or whose entry expired are resolved
+        concurrently and stored with a single transaction.
+
+        @param emails: iterable of email addresses
+        @param resolve: callable returning the Identity of an address
+        @return: dict mapping each address to its Identity or None
+        """
+        emails = set(emails)
+        now = time.time()
+        identities = self._cached(emails, now)
+        stale = sorted(emails - set(identities))
+        self.stats['hit'] += len(identities)
+        self.stats['miss'] += len(stale)
+
+        rows = []
+        for result in fanout.fan_out(resolve, stale):
+            if result.error:
+                raise result.error
+            identity = result.value
+            identities[result.item] = identity
+            if identity is None:
+                rows.append((result.item, None, None, None,
+                             now + self.negative_ttl))
+            else:
+                rows.append((result.item,) + tuple(identity) +
+                            (now + self.ttl,))
+
+        with self._db:
+            self._db.executemany(
+                'insert or replace into identities values (?, ?, ?, ?, ?)',
+                rows)
+        return identities
+
+    def close(self):
+        """Close the database."""
+        self._db.close()
+
+
+def get_identity_cache():
+    """Return an IdentityCache kept in the cache directory."""
+    return IdentityCache(os.path.join(get_cache_dir('launchpad'),
+                                      'identities.sqlite3'))
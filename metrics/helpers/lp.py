@@ -5,68 +5,381 @@ See https://api.launchpad.net/devel.html for more details.
 Copyright 2017 Canonical Ltd.
 Joshua Powers <josh.powers@canonical.com>
 """
+import atexit
+from collections import OrderedDict
 from datetime import datetime, timedelta
+import json
+import os
 import sys
+import tempfile
+import threading
+import time
 
 from launchpadlib.errors import BadRequest
 from launchpadlib.launchpad import Launchpad
 
-LP = Launchpad.login_anonymously('metrics', 'production', version='devel')
+from metrics.helpers import fanout
+from metrics.helpers import fetch
+from metrics.helpers.cachedir import get_cache_dir
+
+COUNT_PAGE_SIZE = 1
+'''entries requested with the first page of a collection that is counted'''
+PAGE_SIZE = 300
+'''entries per page when paging through a collection as raw JSON'''
+PARTICIPANT_ATTRIBUTES = ('name', 'display_name', 'is_valid', 'is_team')
+PARTICIPANTS_TTL = 12 * 3600
+'''seconds for which the participants of a team are kept between runs'''
+ENTITY_CACHE_SIZE = 1024
+ENTITY_CACHE_TTL = 3600
+'''seconds for which a resolved Launchpad entry is reused'''
+
+_LOCAL = threading.local()
+STARTUP_TIMINGS = []
+'''seconds taken by each Launchpad login in this process'''
+
+
+def get_launchpad():
+    """
+    Return this thread's Launchpad handle, logging in on first use.
+
+    launchpadlib objects must not be shared between threads, so each thread
+    gets its own handle. They share a persistent launchpadlib cache
+    directory, so the service description is revalidated rather than
+    downloaded again by every login and every process.
+    """
+    launchpad = getattr(_LOCAL, 'launchpad', None)
+    if launchpad is None:
+        start = time.monotonic()
+        launchpad = Launchpad.login_anonymously(
+            'metrics', 'production', version='devel',
+            launchpadlib_dir=get_cache_dir('launchpadlib'))
+        STARTUP_TIMINGS.append(time.monotonic() - start)
+        _LOCAL.launchpad = launchpad
+
+    return launchpad
+
+
+class _LazyLaunchpad:  # pylint: disable=too-few-public-methods
+    """Stand-in for a Launchpad handle that logs in on first use."""
+
+    def __getattr__(self, name):
+        return getattr(get_launchpad(), name)
+
+
+LP = _LazyLaunchpad()
+
+
+class EntityCache:
+    """A size-bounded LRU cache of Launchpad entries with a time to live."""
+
+    def __init__(self, maxsize=ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL):
+        """Construct the class."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stats = {'hit': 0, 'miss': 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _put(self, key, value, now):
+        self._entries[key] = (now, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get(self, key, loader):
+        """
+        Return the entry cached under key, calling loader() on a miss.
+
+        Entries are cached per thread's Launchpad handle, since they must
+        not be used from other threads. An entry that has a self_link is
+        also cached under it, so that it is found by link as well as by
+        the key it was first resolved with.
+
+        :param key: hashable key, such as ('people', name) or a self_link
+        :param loader: callable returning the entry for key
+        """
+        handle = id(get_launchpad())
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get((handle, key))
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries.move_to_end((handle, key))
+                self.stats['hit'] += 1
+                return entry[1]
+            self.stats['miss'] += 1
+
+        value = loader()
+        with self._lock:
+            self._put((handle, key), value, now)
+            self_link = getattr(value, 'self_link', None)
+            if self_link is not None and self_link != key:
+                self._put((handle, self_link), value, now)
+        return value
+
+    def clear(self):
+        """Forget every cached entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def report(self):
+        """Print the cache hit and miss counts, if it has been used."""
+        if any(self.stats.values()):
+            print('Launchpad entity cache: %(hit)s hits, %(miss)s misses' %
+                  self.stats)
+
+
+ENTITY_CACHE = EntityCache()
+atexit.register(ENTITY_CACHE.report)
+
+
+def load(link):
+    """Return the Launchpad entry at link."""
+    return ENTITY_CACHE.get(link, lambda: LP.load(link))
+
+
+def get_distribution(name):
+    """Return the Launchpad distribution called name."""
+    return ENTITY_CACHE.get(('distributions', name.lower()),
+                            lambda: LP.distributions[name])
+
+
+def get_person(name):
+    """Return the Launchpad person or team called name."""
+    return ENTITY_CACHE.get(('people', name), lambda: LP.people[name])
+
+
+def get_project(name):
+    """Return the Launchpad project called name."""
+    return ENTITY_CACHE.get(('projects', name), lambda: LP.projects[name])
+
+
+def _count_url(operation, kwargs):
+    """Return the URL of a GET named operation, for a minimal first page."""
+    # pylint: disable=protected-access
+    method = operation.wadl_method
+    if method.name != 'get':
+        raise ValueError('%s is not a GET operation' % method.name)
+
+    args = operation._transform_resources_to_links(kwargs)
+    # like launchpadlib, send option and binary values as they are and
+    # everything else JSON-encoded
+    as_is = {param.name for param in method.request.query_params
+             if param.type == 'binary' or param.options}
+    for key, value in args.items():
+        if key not in as_is:
+            args[key] = json.dumps(value, default=lambda obj: obj.isoformat())
+
+    url = method.build_request_url(**args)
+    return '%s%sws.size=%d' % (url, '&' if '?' in url else '?',
+                               COUNT_PAGE_SIZE)
+
+
+def _get_json(browser, url):
+    content = browser.get(url)
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    return json.loads(content)
+
+
+def count(operation, **kwargs):
+    """
+    Return the number of entries in the collection an operation returns.
+
+    Only a single-entry first page is requested and the size reported by
+    the server in it is returned, so counting a large collection takes one
+    request (two if the server reports the size as total_size_link).
+    If the size is not reported, the whole collection is paged through.
+
+    :param operation: named operation returning a collection, such as
+        distribution.searchTasks
+    :param kwargs: arguments of the operation
+    """
+    try:
+        url = _count_url(operation, kwargs)
+    except (AttributeError, TypeError, ValueError):
+        # not a GET operation, or a launchpadlib that builds them
+        # differently
+        return sum(1 for _ in operation(**kwargs))
+
+    browser = operation.root._browser  # pylint: disable=protected-access
+    page = _get_json(browser, url)
+    if isinstance(page.get('total_size'), int):
+        return page['total_size']
+    if page.get('total_size_link'):
+        return _get_json(browser, page['total_size_link'])
+
+    return sum(1 for _ in operation(**kwargs))
+
+
+def _get_page(url):
+    """
+    Return a page of a collection as JSON.
+
+    Collections are read anonymously, so pages are fetched through the
+    shared HTTP session from any thread, without a Launchpad login.
+    """
+    response = fetch.get_session().get(
+        url, headers={'Accept': 'application/json'})
+    response.raise_for_status()
+    return response.json()
+
+
+def _page_url(url, start):
+    return '%s%sws.start=%d&ws.size=%d' % (url, '&' if '?' in url else '?',
+                                           start, PAGE_SIZE)
+
+
+def iter_raw_entries(urls):
+    """
+    Yield the entries of collections as (collection URL, JSON dict) pairs.
+
+    The first pages of all collections are fetched concurrently, then all
+    remaining pages at once, addressed by their offsets. No Entry objects
+    are created, so nothing is loaded per entry.
+
+    :param urls: URLs of collections, such as a team's participants or
+        the result of a named GET operation
+    """
+    remaining = []
+    for result in fanout.fan_out(lambda url: _get_page(_page_url(url, 0)),
+                                 urls):
+        if result.error:
+            raise result.error
+        page = result.value
+        for entry in page['entries']:
+            yield result.item, entry
+
+        total_size = page.get('total_size')
+        if total_size is None and page.get('total_size_link'):
+            total_size = _get_page(page['total_size_link'])
+        if total_size is None:
+            # size unknown, follow the links from page to page
+            while page.get('next_collection_link'):
+                page = _get_page(page['next_collection_link'])
+                for entry in page['entries']:
+                    yield result.item, entry
+            continue
+        remaining.extend((result.item, start)
+                         for start in range(PAGE_SIZE, total_size, PAGE_SIZE))
+
+    for result in fanout.fan_out(lambda page: _get_page(_page_url(*page)),
+                                 remaining):
+        if result.error:
+            raise result.error
+        for entry in result.value['entries']:
+            yield result.item[0], entry
+
+
+def _participants_path(team):
+    return os.path.join(get_cache_dir('launchpad'),
+                        'participants-%s.json' % team)
+
+
+def _load_participants(team, ttl):
+    try:
+        with open(_participants_path(team)) as participants_file:
+            cached = json.load(participants_file)
+    except (OSError, ValueError):
+        return None
+    if time.time() - cached['fetched'] >= ttl:
+        return None
+    return cached['participants']
+
+
+def _save_participants(team, participants):
+    path = _participants_path(team)
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path),
+                                     delete=False) as participants_file:
+        json.dump({'fetched': time.time(), 'participants': participants},
+                  participants_file)
+    os.replace(participants_file.name, path)
+
+
+def get_team_participants(teams, ttl=PARTICIPANTS_TTL):
+    """
+    Return the participants of teams, each person only once.
+
+    The participant lists of all teams are paged through concurrently, see
+    iter_raw_entries. Each team's participants are kept in the cache
+    directory and reused for ttl seconds by later runs.
+
+    :param teams: names of Launchpad teams
+    :param ttl: seconds for which cached participants are used
+    :return: dict mapping the self_link of each participant to a dict of
+        its PARTICIPANT_ATTRIBUTES
+    """
+    participants = {}
+    stale = []
+    for team in teams:
+        cached = _load_participants(team, ttl)
+        if cached is None:
+            stale.append(team)
+        else:
+            participants.update(cached)
+
+    urls = {get_person(team).self_link + '/participants': team
+            for team in stale}
+    fetched = {team: {} for team in stale}
+    for url, entry in iter_raw_entries(urls):
+        fetched[urls[url]][entry['self_link']] = {
+            name: entry.get(name) for name in PARTICIPANT_ATTRIBUTES}
+
+    for team, team_participants in fetched.items():
+        participants.update(team_participants)
+        _save_participants(team, team_participants)
+    return participants
 
 
 def get_series_name(series_link):
     """Return series name."""
-    return LP.load(series_link).name
+    return load(series_link).name
 
 
 def get_person_name(person_link):
     """Return person name."""
     if person_link:
-        return LP.load(person_link).name
+        return load(person_link).name
 
     return None
 
 
 def get_person_by_email(email):
     """Return person object for email."""
-    try:
-        return LP.people.getByEmail(email=email)
-    except BadRequest:
-        return None
+    def get_by_email():
+        try:
+            return LP.people.getByEmail(email=email)
+        except BadRequest:
+            return None
+
+    return ENTITY_CACHE.get(('email', email), get_by_email)
 
 
 def get_ubuntu():
     """Return Ubuntu specific distribution."""
-    return LP.distributions['ubuntu']
+    return get_distribution('ubuntu')
 
 
 def get_bug_count(project, status=None):
     """Report count of open or $status bugs for a project."""
     try:
-        project = LP.projects[project]
+        project = get_project(project)
     except KeyError:
         print('Invalid project name: %s' % project)
         sys.exit(1)
 
     if status:
-        result = project.searchTasks(status=status)
-    else:
-        result = project.searchTasks()
-
-    return len(result)
+        return count(project.searchTasks, status=status)
+    return count(project.searchTasks)
 
 
 def get_ubuntu_bug_count(package, status=None):
     """Report count of open or $status bugs in Ubuntu for a package."""
-    distro = LP.distributions['Ubuntu']
+    distro = get_ubuntu()
     src_pkg = distro.getSourcePackage(name=package)
 
     if status:
-        result = src_pkg.searchTasks(status=status)
-    else:
-        result = src_pkg.searchTasks()
-
-    return len(result)
+        return count(src_pkg.searchTasks, status=status)
+    return count(src_pkg.searchTasks)
 
 
 def get_active_review_count(package):
@@ -90,15 +403,15 @@ def get_bzr_active_review_count(package):
 
 def get_team_backlog_count(team, distro):
     """Report count of open bugs for Launchpad team on a distro."""
-    lp_distro = LP.distributions[distro]
-    lp_team = LP.people[team]
-    return len(lp_distro.searchTasks(bug_subscriber=lp_team))
+    lp_distro = get_distribution(distro)
+    lp_team = get_person(team)
+    return count(lp_distro.searchTasks, bug_subscriber=lp_team)
 
 
 def get_team_daily_triage_count(team, distro, blacklist=None):
     """Report count of open bugs for a Launchpad team that need triage."""
-    lp_distro = LP.distributions[distro]
-    lp_team = LP.people[team]
+    lp_distro = get_distribution(distro)
+    lp_team = get_person(team)
 
     date_start = datetime.now().date().strftime('%Y-%m-%d')
     date_end = (datetime.now().date() + timedelta(days=1)).strftime('%Y-%m-%d')
@@ -123,6 +436,38 @@ def get_team_daily_triage_count(team, distro, blacklist=None):
     return len(results)
 
 
+def count_by_group(items, groups):
+    """
+    Count items into groups in a single pass.
+
+    An item is counted in every group whose predicate it matches, so
+    several queue sizes can be computed from one fetch of a collection.
+
+    :param items: iterable of items, such as bug tasks
+    :param groups: dict mapping group names to predicates on an item
+    :return: dict mapping group names to the number of matching items
+    """
+    counts = {name: 0 for name in groups}
+    for item in items:
+        for name, matches in groups.items():
+            if matches(item):
+                counts[name] += 1
+    return counts
+
+
+def get_team_subscribed_task_counts(team, distro, groups):
+    """
+    Report counts of open bugs for Launchpad team on a distro, by group.
+
+    All open bug tasks the team is subscribed to are fetched once and
+    counted into groups, see count_by_group.
+    """
+    lp_distro = get_distribution(distro)
+    lp_team = get_person(team)
+    return count_by_group(lp_distro.searchTasks(bug_subscriber=lp_team),
+                          groups)
+
+
 def get_team_subscribed_unassigned_bugs(team, distro):
     """
     Report count of new unassigned bugs for Launchpad team on a distro.
@@ -130,18 +475,18 @@ def get_team_subscribed_unassigned_bugs(team, distro):
     List the number of bugs that are New and unassigned for a particular
     team subscribed to the bugs.
     """
-    lp_distro = LP.distributions[distro]
-    lp_team = LP.people[team]
-    return len(lp_distro.searchTasks(bug_subscriber=lp_team, assignee=None,
-                                     status='New'))
+    lp_distro = get_distribution(distro)
+    lp_team = get_person(team)
+    return count(lp_distro.searchTasks, bug_subscriber=lp_team,
+                 assignee=None, status='New')
 
 
 def get_team_subscribed_incomplete_bugs(team, distro):
     """Report count of incomplete bugs for Launchpad team on a distro."""
-    lp_distro = LP.distributions[distro]
-    lp_team = LP.people[team]
-    return len(lp_distro.searchTasks(bug_subscriber=lp_team,
-                                     status='Incomplete'))
+    lp_distro = get_distribution(distro)
+    lp_team = get_person(team)
+    return count(lp_distro.searchTasks, bug_subscriber=lp_team,
+                 status='Incomplete')
 
 
 def get_mirs_in_review():
@@ -151,29 +496,38 @@ def get_mirs_in_review():
     Open, Triaged or Confirmed (so not yet approved) bug would be assumed
     to be "in active review".
     """
-    lp_distro = LP.distributions['Ubuntu']
-    lp_team = LP.people['ubuntu-mir']
-    return len(lp_distro.searchTasks(bug_subscriber=lp_team,
-                                     status=['Triaged', 'Confirmed']))
+    lp_distro = get_ubuntu()
+    lp_team = get_person('ubuntu-mir')
+    return count(lp_distro.searchTasks, bug_subscriber=lp_team,
+                 status=['Triaged', 'Confirmed'])
 
 
 def get_mirs_in_security_review():
     """Report count of open, assigned to Security bugs."""
-    lp_distro = LP.distributions['Ubuntu']
-    lp_team = LP.people['ubuntu-mir']
-    assignee = LP.people['ubuntu-security']
-    return len(lp_distro.searchTasks(bug_subscriber=lp_team,
-                                     assignee=assignee))
+    lp_distro = get_ubuntu()
+    lp_team = get_person('ubuntu-mir')
+    assignee = get_person('ubuntu-security')
+    return count(lp_distro.searchTasks, bug_subscriber=lp_team,
+                 assignee=assignee)
 
 
 def get_approved_mirs():
     """Report count of Fix Committed (pending AA review) MIRs."""
-    lp_distro = LP.distributions['Ubuntu']
-    lp_team = LP.people['ubuntu-mir']
-    return len(lp_distro.searchTasks(bug_subscriber=lp_team,
-                                     status='Fix Committed'))
+    lp_distro = get_ubuntu()
+    lp_team = get_person('ubuntu-mir')
+    return count(lp_distro.searchTasks, bug_subscriber=lp_team,
+                 status='Fix Committed')
 
 
 def is_git_repo(pkg):
     """Determine if package has a git repo or not."""
     return bool(LP.git_repositories.getByPath(path=pkg))
+
+
+if __name__ == '__main__':
+    START = time.monotonic()
+    get_launchpad()
+    print('Launchpad login took %.2fs' % (time.monotonic() - START))
+    START = time.monotonic()
+    NAME = get_ubuntu().name
+    print('Loading %s took %.2fs' % (NAME, time.monotonic() - START))
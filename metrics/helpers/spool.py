@@ -0,0 +1,299 @@
+"""Durable write-behind spool for InfluxDB line protocol.
+
+Points are appended to segment files in a local directory and replayed to
+InfluxDB by a background drainer thread, so a slow or unavailable InfluxDB
+does not block collectors or lose their data.
+
+Segments are written as <name>.open, sealed by renaming them to <name>.lp
+and claimed for draining by renaming them to <name>.<pid>.drain, which
+makes it safe for several processes to share one spool directory. Sealed
+segments left behind by earlier runs are drained along with new ones,
+after the segments of the process itself. A segment InfluxDB rejects as
+bad data is set aside as <name>.rejected instead of being retried.
+
+Copyright 2019 Canonical Ltd.
+"""
+import glob
+import os
+import threading
+import time
+
+from influxdb.exceptions import InfluxDBClientError
+
+SEGMENT_BYTES = 8 * 1024 * 1024
+FSYNC_EVERY = 1000
+DRAIN_BATCH_SIZE = 5000
+BACKOFF_MIN = 1
+BACKOFF_MAX = 300
+OWN_DRAINED_POLL = 0.5
+'''seconds between checks for own segments drained by other processes'''
+REJECTED_CODES = (400,)
+'''InfluxDB write statuses meaning the data itself is bad, as opposed to
+unauthorized writes or a missing database, which are retried'''
+
+
+def _pid_alive(pid):
+    """Return whether a process with the given pid exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _rename_if_present(path, new_path):
+    """Rename path, unless another process recovering it got there first."""
+    try:
+        os.rename(path, new_path)
+    except FileNotFoundError:
+        pass
+
+
+class Spool:  # pylint: disable=too-many-instance-attributes
+    """An append-only, segmented spool of line protocol strings."""
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES,
+                 fsync_every=FSYNC_EVERY):
+        """Construct the class."""
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_every = fsync_every
+        self._lock = threading.Lock()
+        self._segment = None
+        self._unsynced = 0
+        self._counter = 0
+        self._sealed = set()
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    def _recover(self):
+        """Make segments left behind by dead processes drainable again."""
+        for path in glob.glob(os.path.join(self.directory, '*.open')):
+            pid = int(os.path.basename(path).split('-')[1])
+            if not _pid_alive(pid):
+                _rename_if_present(path, path[:-len('.open')] + '.lp')
+
+        for path in glob.glob(os.path.join(self.directory, '*.drain')):
+            pid = int(path.rsplit('.', 2)[1])
+            if not _pid_alive(pid):
+                _rename_if_present(path, path.rsplit('.', 2)[0] + '.lp')
+
+    def _open_segment(self):
+        self._counter += 1
+        name = '%016d-%d-%06d.open' % (time.time() * 1000, os.getpid(),
+                                       self._counter)
+        self._segment = open(os.path.join(self.directory, name), 'a',
+                             encoding='utf-8')
+
+    def _seal_segment(self):
+        if self._segment is None:
+            return
+        self._segment.flush()
+        os.fsync(self._segment.fileno())
+        self._segment.close()
+        base = self._segment.name[:-len('.open')]
+        os.rename(self._segment.name, base + '.lp')
+        self._sealed.add(base)
+        self._segment = None
+        self._unsynced = 0
+
+    def append(self, lines):
+        """Append line protocol strings to the spool.
+
+        @param lines: iterable of line protocol strings
+        @return: number of lines appended
+        """
+        count = 0
+        with self._lock:
+            for line in lines:
+                if self._segment is None:
+                    self._open_segment()
+                self._segment.write(line + '\n')
+                count += 1
+                self._unsynced += 1
+                if self._segment.tell() >= self.segment_bytes:
+                    self._seal_segment()
+                elif self._unsynced >= self.fsync_every:
+                    self._segment.flush()
+                    os.fsync(self._segment.fileno())
+                    self._unsynced = 0
+        return count
+
+    def seal(self):
+        """Seal the current segment so that it can be drained."""
+        with self._lock:
+            self._seal_segment()
+
+    def claim(self):
+        """Claim a sealed segment for draining.
+
+        Segments sealed by this process are claimed first, oldest first,
+        then those of other processes and earlier runs.
+
+        @return: path of the claimed segment, or None if there is none
+        """
+        paths = glob.glob(os.path.join(self.directory, '*.lp'))
+        for path in sorted(paths, key=lambda path: (
+                path[:-len('.lp')] not in self._sealed, path)):
+            claimed = '%s.%d.drain' % (path[:-len('.lp')], os.getpid())
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                # another drainer got there first
+                continue
+            return claimed
+        return None
+
+    def pending(self):
+        """Return the number of sealed segments waiting to be drained."""
+        return len(glob.glob(os.path.join(self.directory, '*.lp')))
+
+    def own_pending(self):
+        """Return the number of segments this process sealed not yet drained.
+
+        Segments drained or rejected by any process are no longer pending.
+        """
+        with self._lock:
+            self._sealed = {base for base in self._sealed
+                            if os.path.exists(base + '.lp') or
+                            glob.glob(glob.escape(base) + '.*.drain')}
+            return len(self._sealed)
+
+
+class Drainer(threading.Thread):
+    # pylint: disable=too-many-instance-attributes
+    """Background thread replaying sealed spool segments to InfluxDB."""
+
+    def __init__(self, spool, connect, batch_size=DRAIN_BATCH_SIZE):
+        """
+        Construct the class.
+
+        @param spool: Spool to drain
+        @param connect: callable returning an InfluxDBClient
+        @param batch_size: number of lines per write request
+        """
+        super().__init__(name='influxdb-spool-drainer', daemon=True)
+        self.spool = spool
+        self.connect = connect
+        self.batch_size = batch_size
+        self._stopping = threading.Event()
+        self._condition = threading.Condition()
+        self._requested = 0
+        self._drained = 0
+        self._failing = False
+
+    def _write_segment(self, path):
+        """Write a claimed segment to InfluxDB in bulk batches."""
+        client = self.connect()
+        with open(path, encoding='utf-8') as segment:
+            batch = []
+            for line in segment:
+                batch.append(line.rstrip('\n'))
+                if len(batch) >= self.batch_size:
+                    client.write_points(batch, protocol='line')
+                    batch = []
+            if batch:
+                client.write_points(batch, protocol='line')
+
+    def drain_once(self):
+        """
+        Drain every sealed segment, raising on the first write error.
+
+        A segment InfluxDB rejects as bad data is renamed to .rejected and
+        draining goes on with the next one; retrying it would only block
+        the segments behind it.
+        """
+        path = self.spool.claim()
+        while path is not None:
+            base = path.rsplit('.', 2)[0]
+            try:
+                self._write_segment(path)
+            except InfluxDBClientError as error:
+                if error.code not in REJECTED_CODES:
+                    os.rename(path, base + '.lp')
+                    raise
+                os.rename(path, base + '.rejected')
+                print('InfluxDB rejected spool segment, kept as %s: %s' %
+                      (base + '.rejected', error))
+            except Exception:
+                # hand the segment back, it is retried after a backoff
+                os.rename(path, base + '.lp')
+                raise
+            else:
+                os.remove(path)
+            with self._condition:
+                self._condition.notify_all()
+            path = self.spool.claim()
+
+    def run(self):
+        """Drain the spool until stopped, backing off on failures."""
+        backoff = BACKOFF_MIN
+        while not self._stopping.is_set():
+            with self._condition:
+                requested = self._requested
+
+            try:
+                self.drain_once()
+            except Exception as exception:  # pylint: disable=broad-except
+                print('InfluxDB spool drain failed, retrying in %ss: %s' %
+                      (backoff, exception))
+                with self._condition:
+                    self._failing = True
+                    self._condition.notify_all()
+                self._stopping.wait(backoff)
+                backoff = min(backoff * 2, BACKOFF_MAX)
+                continue
+            backoff = BACKOFF_MIN
+
+            with self._condition:
+                self._failing = False
+                self._drained = requested
+                self._condition.notify_all()
+                while (self._requested == requested and
+                       not self._stopping.is_set()):
+                    self._condition.wait()
+
+    def wake(self):
+        """Ask the drainer to look for newly sealed segments."""
+        with self._condition:
+            self._requested += 1
+            self._condition.notify_all()
+
+    def wait_drained(self, timeout=None):
+        """Wait until every segment sealed before this call is drained.
+
+        @return: True if they were drained within the timeout
+        """
+        with self._condition:
+            target = self._requested
+            return self._condition.wait_for(
+                lambda: self._drained >= target, timeout)
+
+    def wait_own_drained(self, timeout=None):
+        """
+        Wait until the segments this process sealed are drained.
+
+        Waiting stops early when a drain fails, as the sink is then
+        unavailable and the segments are left for a later run.
+
+        @return: True if they were drained
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while not self._failing and self.spool.own_pending():
+                wait = OWN_DRAINED_POLL
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        return False
+                # other processes draining them do not notify
+                self._condition.wait(wait)
+            return not self._failing
+
+    def stop(self):
+        """Stop the drainer thread."""
+        self._stopping.set()
+        with self._condition:
+            self._condition.notify_all()
@@ -4,7 +4,9 @@ Copyright 2018 Canonical Ltd.
 Aleksandr Bogdanov <aleksandr.bogdanov@canonical.com>
 """
 
+import codecs
 import json
+import re
 from urllib.parse import urljoin
 
 # pylint: disable=import-error
@@ -13,6 +15,9 @@ from simplestreams.filters import ItemFilter as SSFilter
 from simplestreams.generate_simplestreams import FileNamer
 from simplestreams.util import products_exdata, expand_tree
 
+from metrics.helpers import fanout
+from metrics.helpers import fetch
+
 
 UBUNTU_CLOUD_IMAGES_BASE_URL = 'http://cloud-images.ubuntu.com'
 UBUNTU_CLOUD_IMAGE_INDICES = ['releases', 'daily',
@@ -21,14 +26,180 @@ UBUNTU_CLOUD_IMAGE_INDICES = ['releases', 'daily',
 PEDIGREE_STREAM_PROPERTIES = ['cloudname', 'datatype', 'index_path']
 '''simplestream index entry properties to include into product items'''
 
+STREAM_CHUNK_SIZE = 64 * 1024
+LEAF_FILTER_COSTS = {'=': 1, '!=': 1, '~': 2, '!~': 2}
+'''relative cost of evaluating an SSFilter, by its operator'''
+OPAQUE_FILTER_COST = 3
+'''relative cost of evaluating a filter through its own matches method'''
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
 
-class ProductsContentSource(UrlContentSource):
-    """A UrlContentSource that can work with ubuntu-shaped image feeds."""
 
-    def __init__(self, url, mirrors=None, url_reader=None, stream_info=None):
+def cached_url_reader(url, offset=None, user_agent=None):
+    """
+    Open url through the shared HTTP cache, as a simplestreams url_reader.
+
+    Unchanged indices and streams then cost a revalidation request
+    instead of a full download.
+    """
+    del user_agent  # part of the url_reader signature, but not needed
+    body = fetch.open_url(url)
+    if offset:
+        body.seek(offset)
+    return body
+
+
+class _JSONScanner:
+    """Decode the members of JSON objects from chunks of text as they come.
+
+    Only the text of the value being decoded is kept in memory, so a large
+    document can be walked value by value.
+    """
+
+    def __init__(self, chunks):
         """Construct the class."""
+        self._chunks = iter(chunks)
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+
+    def _read(self, size):
+        """Read at least size more characters, False if there are none."""
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        read = 0
+        for chunk in self._chunks:
+            self._buffer += chunk
+            read += len(chunk)
+            if read >= size:
+                break
+        return read > 0
+
+    def _skip_whitespace(self):
+        while True:
+            self._pos = _JSON_WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._read(1):
+                return
+
+    def _consume(self, char):
+        """Consume char if it comes next, returning whether it did."""
+        self._skip_whitespace()
+        if self._buffer.startswith(char, self._pos):
+            self._pos += 1
+            return True
+        return False
+
+    def value(self):
+        """Decode the next value."""
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                # incomplete, read as much again so that retries stay linear
+                if not self._read(max(len(self._buffer) - self._pos,
+                                      STREAM_CHUNK_SIZE)):
+                    raise
+                continue
+            if end == len(self._buffer) and self._read(1):
+                # a number could go on in the next chunk
+                continue
+            self._pos = end
+            return value
+
+    def members(self):
+        """
+        Yield the keys of the object that comes next.
+
+        The value of each key must be consumed, with value() or members(),
+        before asking for the next key.
+        """
+        if not self._consume('{'):
+            raise ValueError('JSON object expected')
+        if self._consume('}'):
+            return
+        while True:
+            key = self.value()
+            if not self._consume(':'):
+                raise ValueError('":" expected after JSON object key')
+            yield key
+            if self._consume(','):
+                continue
+            if self._consume('}'):
+                return
+            raise ValueError('"," or "}" expected in JSON object')
+
+
+def iter_stream_products(chunks):
+    """
+    Walk a products stream one product at a time.
+
+    :param chunks: iterable of text chunks of the stream
+    :return: generator of (top, product_name, product), where top holds the
+        top level properties that precede 'products' in the stream
+    """
+    scanner = _JSONScanner(chunks)
+    top = {}
+    for key in scanner.members():
+        if key == 'products':
+            for product_name in scanner.members():
+                yield top, product_name, scanner.value()
+        else:
+            top[key] = scanner.value()
+
+
+class CachedUrlContentSource(UrlContentSource):
+    # pylint: disable=too-few-public-methods
+    """A UrlContentSource read through the HTTP cache, that can prefetch."""
+
+    def __init__(self, url, mirrors=None, url_reader=None):
+        """Construct the class."""
+        super().__init__(url, mirrors, url_reader or self._read_url)
+        self._prefetched = {}
+
+    def _read_url(self, url, offset=None, user_agent=None):
+        """Open url, using its prefetched body if there is one."""
+        path = self._prefetched.pop(url, None)
+        if path is not None:
+            try:
+                body = open(path, 'rb')
+            except FileNotFoundError:
+                # evicted from the cache since
+                pass
+            else:
+                if offset:
+                    body.seek(offset)
+                return body
+        return cached_url_reader(url, offset, user_agent)
+
+    def prefetch(self):
+        """
+        Download, or revalidate, the content into the HTTP cache now.
+
+        Reading the content afterwards needs no further request, so the
+        content of several sources can be fetched concurrently and then
+        read one after another.
+        """
+        self._prefetched[self.url] = fetch.get_cache().refresh(self.url)
+        return self
+
+
+class ProductsContentSource(CachedUrlContentSource):
+    """A UrlContentSource that can work with ubuntu-shaped image feeds."""
+
+    def __init__(self, url, mirrors=None, url_reader=None, stream_info=None,
+                 streaming=False):
+        """
+        Construct the class.
+
+        With streaming, products are parsed one at a time as the stream is
+        read, so memory use is bounded by the largest product rather than
+        by the whole stream. Only the top level properties that precede
+        'products' in the stream are then inherited by its items; streams
+        written with sorted keys have 'updated' after 'products'.
+        """
         super().__init__(url, mirrors, url_reader)
         self.info = stream_info or {}
+        self.streaming = streaming
 
     def _extend_item_info(self, item):
         for prop in PEDIGREE_STREAM_PROPERTIES:
@@ -37,23 +208,63 @@ class ProductsContentSource(UrlContentSource):
                 item[prop] = val
         return item
 
+    def item_properties(self):
+        """
+        Return the properties every item of this stream will have.
+
+        These are the index entry properties copied onto every item, and
+        content_id, which simplestreams defines per stream.
+        """
+        known = {prop: self.info[prop] for prop in PEDIGREE_STREAM_PROPERTIES
+                 if self.info.get(prop)}
+        if 'content_id' in self.info:
+            known['content_id'] = self.info['content_id']
+        return known
+
+    def may_have_items(self, itemfilter):
+        """Return False if no item of this stream can match the filter."""
+        return partial_match(itemfilter, self.item_properties()) is not False
+
+    def _product_properties(self, stream, product_name):
+        """Return the properties every item of a product will have."""
+        product = stream['products'][product_name]
+        known = _scalars(stream)
+        known.update(_scalars(product))
+        known['product_name'] = product_name
+
+        # versions and items may override what they inherit
+        for version in product.get('versions', {}).values():
+            for key in version:
+                known.pop(key, None)
+            for item in version.get('items', {}).values():
+                for key in item:
+                    known.pop(key, None)
+
+        known.update(self.item_properties())
+        return known
+
     def get_product_items(self, itemfilter=None):
         """
         Parse products from this ContentSource, matching the filter.
 
         :type itemfilter: Optional[SSFilter]
         """
-        itemfilter = itemfilter or AndFilter()  # empty AndFilter is true
+        # empty AndFilter is true
+        matches = compile_filter(itemfilter or AndFilter())
 
-        contents = super().read()
-        super().close()
-        stream = json.loads(contents)
-        assert stream.get('format') == 'products:1.0', \
-            'simplestreams product stream is of supported version'
+        if self.streaming:
+            trees = self._read_product_trees()
+        else:
+            trees = self._read_tree()
 
-        expand_tree(stream)
+        for stream, product_name in trees:
+            if itemfilter is not None and partial_match(
+                    itemfilter,
+                    self._product_properties(stream, product_name)) is False:
+                # no item of this product can match
+                continue
 
-        for product_name, product in stream.get('products', {}).items():
+            product = stream['products'][product_name]
             for version_name, version in product.get('versions', {}).items():
                 for item_name, item in version.get('items', {}).items():
 
@@ -61,9 +272,43 @@ class ProductsContentSource(UrlContentSource):
                     item = products_exdata(stream, pedigree)
                     item = self._extend_item_info(item)
 
-                    if itemfilter.matches(item):
+                    if matches(item):
                         yield item
 
+    def _read_tree(self):
+        """Yield the whole stream, once for each of its product names."""
+        contents = super().read()
+        super().close()
+        stream = json.loads(contents)
+        assert stream.get('format') == 'products:1.0', \
+            'simplestreams product stream is of supported version'
+
+        expand_tree(stream)
+
+        for product_name in stream.get('products', {}):
+            yield stream, product_name
+
+    def _read_chunks(self):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        try:
+            for chunk in iter(lambda: super(ProductsContentSource, self).read(
+                    STREAM_CHUNK_SIZE), b''):
+                yield decoder.decode(chunk)
+            yield decoder.decode(b'', final=True)
+        finally:
+            super().close()
+
+    def _read_product_trees(self):
+        """Yield a stream with a single product, for each of its products."""
+        for top, product_name, product in iter_stream_products(
+                self._read_chunks()):
+            assert top.get('format') == 'products:1.0', \
+                'simplestreams product stream is of supported version'
+
+            stream = dict(top, products={product_name: product})
+            expand_tree(stream)
+            yield stream, product_name
+
     def __str__(self):
         """Return str(self)."""
         return '<{}({})>'.format(type(self).__name__, self.url)
@@ -72,10 +317,11 @@ class ProductsContentSource(UrlContentSource):
 STREAM_READERS = {'products:1.0': ProductsContentSource}
 
 
-class IndexContentSource(UrlContentSource):
+class IndexContentSource(CachedUrlContentSource):
     """A UrlContentSource that can work with ubuntu-shaped stream indices."""
 
-    def __init__(self, base_url, entry_readers=None, info=None):
+    def __init__(self, base_url, entry_readers=None, info=None,
+                 streaming=False):
         """Construct the class."""
         base_url = base_url.rstrip('/') + '/'
         known_idx_path = FileNamer.get_index_path()
@@ -83,6 +329,7 @@ class IndexContentSource(UrlContentSource):
         self.base_url = base_url
         self.entry_readers = entry_readers or STREAM_READERS
         self.info = info or {}
+        self.streaming = streaming
 
     def get_product_streams(self, itemfilter=None):
         """
@@ -90,7 +337,7 @@ class IndexContentSource(UrlContentSource):
 
         :type itemfilter: Optional[SSFilter]
         """
-        itemfilter = itemfilter or AndFilter()
+        matches = compile_filter(itemfilter or AndFilter())
 
         contents = super().read()
         super().close()
@@ -105,11 +352,12 @@ class IndexContentSource(UrlContentSource):
 
             info.update(self.info)  # copying index properties onto stream
 
-            if itemfilter.matches(info):
+            if matches(info):
                 stream_reader_cls = self.entry_readers[info['format']]
                 stream = stream_reader_cls(
                     urljoin(self.base_url, info['path']),
-                    stream_info=info
+                    stream_info=info,
+                    streaming=self.streaming
                 )
                 yield stream
 
@@ -125,25 +373,57 @@ class UbuntuCloudImages:
     ''':type: List[IndexContentSource]'''
 
     def __init__(self, base_url=UBUNTU_CLOUD_IMAGES_BASE_URL,
-                 index_paths=None):
-        """Construct the class."""
+                 index_paths=None, streaming=False, prefetch=0):
+        """
+        Construct the class.
+
+        With prefetch, up to that many indices and streams are downloaded
+        concurrently ahead of the one being read. They are still read, and
+        their streams and items generated, in the same order as without.
+        """
+        self.prefetch = prefetch
         self.indexes = []
         for index in (index_paths or UBUNTU_CLOUD_IMAGE_INDICES):
             self.indexes.append(
                 IndexContentSource(
                     urljoin(base_url, index),
-                    info={'index_path': index}
+                    info={'index_path': index},
+                    streaming=streaming
                 )
             )
 
-    def get_product_streams(self, stream_filter=None):
-        """Aggregate get_product_streams of all the sub-indexes in Ubuntu."""
-        for index in self.indexes:
-            yield from index.get_product_streams(stream_filter)
+    def get_product_streams(self, stream_filter=None, item_filter=None):
+        """
+        Aggregate get_product_streams of all the sub-indexes in Ubuntu.
+
+        With item_filter, streams none of whose items can match it are
+        left out, without being downloaded.
+        """
+        if not self.prefetch:
+            yield from self._matching_streams(self.indexes, stream_filter,
+                                              item_filter)
+            return
+
+        def prefetched(sources):
+            for result in fanout.iter_fan_out(lambda source: source.prefetch(),
+                                              sources, self.prefetch):
+                if result.error:
+                    raise result.error
+                yield result.value
+
+        yield from prefetched(self._matching_streams(
+            prefetched(self.indexes), stream_filter, item_filter))
+
+    @staticmethod
+    def _matching_streams(indexes, stream_filter, item_filter):
+        for index in indexes:
+            for stream in index.get_product_streams(stream_filter):
+                if item_filter is None or stream.may_have_items(item_filter):
+                    yield stream
 
     def get_product_items(self, stream_filter=None, item_filter=None):
         """Aggregate get_product_items of all streams of all sub-indexes."""
-        for stream in self.get_product_streams(stream_filter):
+        for stream in self.get_product_streams(stream_filter, item_filter):
             yield from stream.get_product_items(item_filter)
 
 
@@ -152,10 +432,89 @@ def ifilter(*expr, noneval=""):
     return AndFilter(*[SSFilter(e, noneval) for e in expr])
 
 
+def _compile_leaf(leaf):
+    """Return a predicate equivalent to an SSFilter, and its cost."""
+    key = getattr(leaf, 'key', None)
+    operator = getattr(leaf, 'op', None)
+    if key is None or operator not in LEAF_FILTER_COSTS:
+        return leaf.matches, OPAQUE_FILTER_COST
+
+    value = leaf.value
+    noneval = getattr(leaf, 'noneval', '')
+    positive = not operator.startswith('!')
+    if operator in ('=', '!='):
+        def predicate(item):
+            return (str(item.get(key, noneval)) == value) is positive
+    else:
+        search = re.compile(value).search
+
+        def predicate(item):
+            return (search(str(item.get(key, noneval))) is not None) \
+                is positive
+
+    return predicate, LEAF_FILTER_COSTS[operator]
+
+
+def _scalars(data):
+    """Return the properties of a stream level that its items inherit."""
+    return {key: value for key, value in data.items()
+            if isinstance(value, (str, int, float))}
+
+
+def partial_match(itemfilter, known):
+    """
+    Evaluate a filter tree knowing only some properties of an item.
+
+    Leaves on unknown properties are undecided, and logic filters combine
+    outcomes with three-valued logic, so a whole stream or product can be
+    skipped when the properties shared by all its items already decide
+    the filter.
+
+    :type itemfilter: Union[SSFilter, MultiFilter]
+    :param known: dict of the properties known so far
+    :return: True or False if the outcome is decided, None otherwise
+    """
+    if not isinstance(itemfilter, MultiFilter):
+        if getattr(itemfilter, 'key', None) in known:
+            return bool(itemfilter.matches(known))
+        return None
+
+    outcomes = [partial_match(f, known) for f in itemfilter.filters]
+    decided_by = itemfilter.decided_by
+    if decided_by is not None and decided_by in outcomes:
+        return itemfilter.operation([decided_by])
+    if None in outcomes:
+        return None
+    return itemfilter.operation(outcomes)
+
+
+def _compile(itemfilter):
+    """Return a predicate equivalent to a filter tree, and its cost."""
+    if isinstance(itemfilter, MultiFilter):
+        return itemfilter.compile_with_cost()
+    return _compile_leaf(itemfilter)
+
+
+def compile_filter(itemfilter):
+    """
+    Compile a filter tree into a single predicate on items.
+
+    Regular expressions are compiled once, the children of every logic
+    filter are evaluated cheapest first, and evaluation stops as soon as
+    the outcome is known.
+
+    :type itemfilter: Union[SSFilter, MultiFilter]
+    :return: callable taking an item dict and returning a bool
+    """
+    return _compile(itemfilter)[0]
+
+
 class MultiFilter:
     """Item filtering helper for syntax sugar."""
 
     symbol = ''
+    decided_by = None
+    '''child outcome that decides the outcome of the whole filter'''
 
     @staticmethod
     def operation(value):
@@ -169,6 +528,7 @@ class MultiFilter:
         :type: filters: List[Union[SSFilter, 'MultiFilter']]
         """
         self.filters = filters
+        self._predicate = None
 
     def __str__(self):
         """Return str(self)."""
@@ -188,11 +548,36 @@ class MultiFilter:
         """Provide syntactic sugar."""
         return NotFilter(self)
 
+    def compile_with_cost(self):
+        """Return a predicate equivalent to this filter, and its cost."""
+        children = sorted((_compile(f) for f in self.filters),
+                          key=lambda child: child[1])
+        predicates = tuple(predicate for predicate, _ in children)
+        cost = sum(cost for _, cost in children)
+
+        if self.decided_by is None:
+            operation = self.operation
+
+            def predicate(item):
+                return operation([bool(p(item)) for p in predicates])
+            return predicate, cost
+
+        decided_by = self.decided_by
+        decided = self.operation([decided_by])
+        undecided = not decided
+
+        def short_circuit(item):
+            for child in predicates:
+                if bool(child(item)) is decided_by:
+                    return decided
+            return undecided
+        return short_circuit, cost
+
     def matches(self, item):
         """Check if the item dict passes the current filter collection."""
-        filters_eval = [f.matches(item) for f in self.filters]
-        retval = self.operation(filters_eval)
-        return retval
+        if self._predicate is None:
+            self._predicate = compile_filter(self)
+        return self._predicate(item)
 
     def non_matching_recursive_filters(self, item):
         """
@@ -218,6 +603,7 @@ class OrFilter(MultiFilter):
 
     operation = any
     symbol = 'any'
+    decided_by = True
 
 
 class AndFilter(MultiFilter):
@@ -225,12 +611,14 @@ class AndFilter(MultiFilter):
 
     operation = all
     symbol = 'all'
+    decided_by = False
 
 
 class NotFilter(MultiFilter):
     """Item filtering helper for syntax sugar."""
 
     symbol = '!'
+    decided_by = True
 
     @staticmethod
     def operation(value):
@@ -4,6 +4,8 @@ Copyright 2017 Canonical Ltd.
 Robbie Basak <robie.basak@canonical.com>
 Joshua Powers <josh.powers@canonical.com>
 """
+import atexit
+import datetime
 import json
 import os
 import re
@@ -11,19 +13,30 @@ import shlex
 import subprocess
 import sys
 import tempfile
+import threading
+from itertools import islice
 import git
 try:
     from urllib.error import URLError
-    from urllib.request import urlopen
 except ImportError:
     # Python 2
     from urllib2 import URLError
-    from urllib2 import urlopen
 
 from influxdb import InfluxDBClient
+from influxdb.line_protocol import make_lines
 from prometheus_client import push_to_gateway
 
+from metrics.helpers import fetch
+from metrics.helpers import spool
+
 INSTANCE = 'ubuntu-server'
+INFLUXDB_BATCH_SIZE = 5000
+INFLUXDB_SPOOL_DRAIN_TIMEOUT = 10
+
+_INFLUXDB_CLIENT = None
+_INFLUXDB_SPOOL = None
+_INFLUXDB_DRAINER = None
+_INFLUXDB_LOCK = threading.Lock()
 
 
 def bzr_contributors(pkg):
@@ -76,12 +89,9 @@ def get_contributors(project):
     return git_contributors(project)
 
 
-def get_json_from_url(json_url):
-    """Return JSON from a URL."""
-    with urlopen(json_url) as url:
-        data = json.loads(url.read().decode())
-
-    return data
+def get_json_from_url(json_url, ttl=0):
+    """Return JSON from a URL, through the HTTP cache."""
+    return json.loads(fetch.get_text(json_url, ttl))
 
 
 def get_team_packages(team='ubuntu-server'):
@@ -103,29 +113,132 @@ def get_launchpad_team_name(team):
 
 
 def influxdb_connect():
-    """Connect to an InfluxDB instance."""
-    try:
-        hostname = os.environ['INFLUXDB_HOSTNAME']
-        port = os.environ['INFLUXDB_PORT']
-        username = os.environ['INFLUXDB_USERNAME']
-        password = os.environ['INFLUXDB_PASSWORD']
-        database = os.environ['INFLUXDB_DATABASE']
-    except KeyError:
-        print('error: please source influx credentials before running')
-        sys.exit(1)
+    """Return the shared InfluxDB client, connecting on first use.
+
+    The client, and the pool of keep-alive HTTP connections behind it, is
+    kept for the lifetime of the process so that every collector and every
+    influxdb_insert call reuses it. It is closed at interpreter exit.
+    """
+    global _INFLUXDB_CLIENT  # pylint: disable=global-statement
+
+    with _INFLUXDB_LOCK:
+        if _INFLUXDB_CLIENT is not None:
+            return _INFLUXDB_CLIENT
+
+        try:
+            hostname = os.environ['INFLUXDB_HOSTNAME']
+            port = os.environ['INFLUXDB_PORT']
+            username = os.environ['INFLUXDB_USERNAME']
+            password = os.environ['INFLUXDB_PASSWORD']
+            database = os.environ['INFLUXDB_DATABASE']
+        except KeyError:
+            print('error: please source influx credentials before running')
+            sys.exit(1)
+
+        _INFLUXDB_CLIENT = InfluxDBClient(hostname, port, username, password,
+                                          database, gzip=True)
+        atexit.register(influxdb_close)
+
+    return _INFLUXDB_CLIENT
+
+
+def influxdb_close():
+    """Close the shared InfluxDB client and its pooled connections."""
+    global _INFLUXDB_CLIENT  # pylint: disable=global-statement
+
+    with _INFLUXDB_LOCK:
+        if _INFLUXDB_CLIENT is not None:
+            _INFLUXDB_CLIENT.close()
+            _INFLUXDB_CLIENT = None
+
 
-    return InfluxDBClient(hostname, port, username, password, database)
+def influxdb_lines(points):
+    """Serialize InfluxDB point dictionaries to line protocol, one by one.
+
+    @param points: iterable of dictionaries of data
+    @return: generator of line protocol strings
+    """
+    for point in points:
+        yield make_lines({'points': [point]}).rstrip('\n')
+
+
+def _influxdb_timestamped(points):
+    """Give points without a time the time they were produced at."""
+    now = datetime.datetime.utcnow()
+    for point in points:
+        if 'time' not in point:
+            point = dict(point, time=now)
+        yield point
+
+
+def _influxdb_spool():
+    """Return the shared spool, starting its drainer on first use."""
+    # pylint: disable=global-statement
+    global _INFLUXDB_SPOOL, _INFLUXDB_DRAINER
+
+    with _INFLUXDB_LOCK:
+        if _INFLUXDB_SPOOL is None:
+            _INFLUXDB_SPOOL = spool.Spool(os.environ['INFLUXDB_SPOOL_DIR'])
+            _INFLUXDB_DRAINER = spool.Drainer(_INFLUXDB_SPOOL,
+                                              influxdb_connect)
+            _INFLUXDB_DRAINER.start()
+            atexit.register(_influxdb_spool_close)
+
+    return _INFLUXDB_SPOOL
+
+
+def _influxdb_spool_close():
+    """
+    Give the drainer a bounded amount of time to write this run's points.
+
+    Only the segments of this process are waited for, and not at all once
+    a drain has failed. Older backlog is left to later runs.
+    """
+    _INFLUXDB_SPOOL.seal()
+    _INFLUXDB_DRAINER.wake()
+    if not _INFLUXDB_DRAINER.wait_own_drained(INFLUXDB_SPOOL_DRAIN_TIMEOUT):
+        print('InfluxDB spool not drained, %s segments left for later' %
+              _INFLUXDB_SPOOL.pending())
+    _INFLUXDB_DRAINER.stop()
 
 
 def influxdb_insert(data, batch_size=None):
     """Write given data to InfluxDB.
 
-    @param data: array of dictionaries of data
+    Points are serialized as they are consumed and sent in gzip-compressed
+    batches, so data can be a generator: a batch is written as soon as it
+    is full and memory use does not grow with the number of points.
+
+    If INFLUXDB_SPOOL_DIR is set the points are instead appended to a local
+    spool there and written by a background drainer, which retries with
+    backoff while InfluxDB is unavailable. Points without a time are given
+    the current one so that a late replay does not shift them.
+
+    @param data: iterable of dictionaries of data
+    @param batch_size: number of points sent per request
+    @return: number of points written
     """
     client = influxdb_connect()
 
-    if data:
-        client.write_points(data, batch_size=batch_size)
+    if os.environ.get('INFLUXDB_SPOOL_DIR'):
+        points_spool = _influxdb_spool()
+        written = points_spool.append(
+            influxdb_lines(_influxdb_timestamped(data)))
+        points_spool.seal()
+        _INFLUXDB_DRAINER.wake()
+        return written
+
+    lines = influxdb_lines(data)
+    batch_size = batch_size or INFLUXDB_BATCH_SIZE
+
+    written = 0
+    batch = list(islice(lines, batch_size))
+    while batch:
+        client.write_points(batch, protocol='line')
+        written += len(batch)
+        batch = list(islice(lines, batch_size))
+
+    return written
 
 
 def run(cmd):
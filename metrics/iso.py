@@ -6,10 +6,11 @@ Joshua Powers <josh.powers@canonical.com>
 """
 import argparse
 import re
-import urllib.request
 
 import distro_info
+import requests
 
+from metrics.helpers import fetch
 from metrics.helpers import util
 
 BASE_URL = 'http://cdimage.ubuntu.com/ubuntu-server/'
@@ -25,9 +26,8 @@ def get_iso_size_data(release, lts=False):
 
     try:
         print(url)
-        response = urllib.request.urlopen(url)
-        text = response.read().decode('utf-8')
-    except urllib.error.HTTPError:
+        text = fetch.get_text(url)
+    except requests.HTTPError:
         return results
 
     for arch in results:
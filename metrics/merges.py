@@ -6,8 +6,8 @@ Joshua Powers <josh.powers@canonical.com>
 """
 import argparse
 from collections import defaultdict, deque
-import urllib.request
 
+from metrics.helpers import fetch
 from metrics.helpers import util
 
 URL_TEMPLATE = 'https://merges.ubuntu.com/stats-{launchpad_team_name}.txt'
@@ -20,8 +20,7 @@ def get_merge_data(team_name):
     metric_url = URL_TEMPLATE.format(
         launchpad_team_name=util.get_launchpad_team_name(team_name))
 
-    response = urllib.request.urlopen(metric_url)
-    data = response.read().decode('utf-8').split('\n')
+    data = fetch.get_text(metric_url).split('\n')
     entries = deque(filter(None, data), 4)
 
     for entry in entries:
@@ -15,13 +15,23 @@ from metrics.helpers import util
 
 def collect(dryrun=False):
     """Submit data to Push Gateway."""
-    unassigned = lp.get_team_subscribed_unassigned_bugs(team='ubuntu-mir',
-                                                        distro='Ubuntu')
-    incomplete = lp.get_team_subscribed_incomplete_bugs(team='ubuntu-mir',
-                                                        distro='Ubuntu')
-    pending = lp.get_mirs_in_review()
-    security = lp.get_mirs_in_security_review()
-    approved = lp.get_approved_mirs()
+    security_link = lp.get_person('ubuntu-security').self_link
+    counts = lp.get_team_subscribed_task_counts('ubuntu-mir', 'Ubuntu', {
+        'unassigned': lambda task: (task.status == 'New' and
+                                    task.assignee_link is None),
+        'incomplete': lambda task: task.status == 'Incomplete',
+        # Open, Triaged or Confirmed (so not yet approved) bug would be
+        # assumed to be "in active review"
+        'pending': lambda task: task.status in ('Triaged', 'Confirmed'),
+        'security': lambda task: task.assignee_link == security_link,
+        # pending AA review
+        'approved': lambda task: task.status == 'Fix Committed',
+    })
+    unassigned = counts['unassigned']
+    incomplete = counts['incomplete']
+    pending = counts['pending']
+    security = counts['security']
+    approved = counts['approved']
 
     print('Unassigned Total: %s' % unassigned)
     print('Incomplete Total: %s' % incomplete)
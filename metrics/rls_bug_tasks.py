@@ -5,11 +5,12 @@ Copyright 2017-2018 Canonical Ltd.
 Daniel Watkins <daniel.watkins@canonical.com>
 """
 import argparse
+import functools
 import re
 import sys
 
-import requests
-
+from metrics.helpers import fanout
+from metrics.helpers import fetch
 from metrics.helpers import util
 
 
@@ -20,18 +21,17 @@ TAGS = ['incoming', 'tracking']
 
 
 def _get_latest_release_prefix():
-    response = requests.get(REPORT_PARENT)
-    release_prefixes = set(re.findall(r'rls-([a-z]+)-incoming', response.text))
+    release_prefixes = set(re.findall(r'rls-([a-z]+)-incoming',
+                                      fetch.get_text(REPORT_PARENT)))
     recent_release_prefixes = (
         prefix for prefix in release_prefixes if len(prefix) == 2)
     return sorted(recent_release_prefixes)[-1]
 
 
 def _get_tag_counts(release_prefix, tag):
-    response = requests.get(REPORT_URL_PATTERN.format(
+    report = fetch.get_text(REPORT_URL_PATTERN.format(
         release_prefix=release_prefix, tag=tag))
-    tag_pairs = re.findall(r'<span id="(.+)-total">(\d+)</span>',
-                           response.text)
+    tag_pairs = re.findall(r'<span id="(.+)-total">(\d+)</span>', report)
     if len(tag_pairs) == 0:
         print('No tag counts found; report may be broken. Exiting now to'
               ' avoid pushing invalid data.')
@@ -43,8 +43,12 @@ def collect(dryrun=False):
     """Submit data to Push Gateway."""
     latest_release_prefix = _get_latest_release_prefix()
     counts = {}
-    for tag in TAGS:
-        counts[tag] = _get_tag_counts(latest_release_prefix, tag)
+    responses = fanout.fan_out(
+        functools.partial(_get_tag_counts, latest_release_prefix), TAGS)
+    for response in responses:
+        if response.error:
+            raise response.error
+        counts[response.item] = response.value
     print(counts)
     if not dryrun:
         print('Pushing data...')
@@ -19,7 +19,7 @@ STATUS_LIST = [
 
 def collect(team_name, dryrun=False):
     """Collect data and push to InfluxDB."""
-    team = lp.LP.people[team_name]
+    team = lp.get_person(team_name)
 
     counts = {i: dict.fromkeys(STATUS_LIST, 0) for i in IMPORTANCE_LIST}
     tasks = lp.LP.bugs.searchTasks(assignee=team, status=STATUS_LIST)
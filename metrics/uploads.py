@@ -1,16 +1,32 @@
 #!/usr/bin/env python3
 """Generate daily upload report.
 
+Uploads are counted per day. The creation date of the newest publication
+seen is kept as a watermark in the cache directory, so each run only asks
+Launchpad for publications created since then. Every day from the
+watermark to today gets a point timestamped at the start of the day,
+which fills in days missed by earlier runs and makes repeated runs
+overwrite the same points rather than adding new ones.
+
 Copyright 2017-2018 Canonical Ltd.
 Robbie Basak <robie.basak@canonical.com>
 Joshua Powers <josh.powers@canonical.com>
 """
 import argparse
-
-from datetime import datetime
+from datetime import datetime, timedelta
+import json
+import os
+import tempfile
 
 from metrics.helpers import lp
 from metrics.helpers import util
+from metrics.helpers.cachedir import get_cache_dir
+
+DAY_FORMAT = '%Y-%m-%d'
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+WATERMARK_MARGIN = timedelta(hours=1)
+'''how long before the watermark each query starts: date_created is set
+when a transaction starts, so a publication can appear after newer ones'''
 
 
 def print_result(upload, category):
@@ -20,17 +36,10 @@ def print_result(upload, category):
                                   upload['pocket'], upload['sponsor']))
 
 
-def generate_upload_report(date, team_name):
-    """Given a date, get uploads for that day."""
-    results = {'dev': 0, 'sru': 0}
-
-    packages = util.get_team_packages(util.get_launchpad_team_name(team_name))
-    ubuntu = lp.get_ubuntu()
-    devel = ubuntu.current_series_link.split('/')[-1]
-    archive = ubuntu.main_archive
-
+def _package_publications(archive, packages, date):
+    """Yield the team's publications, querying each package in turn."""
     for package in packages:
-        spphs = archive.getPublishedSources(
+        yield from archive.getPublishedSources(
             created_since_date=date,
             # essential ordering for migration detection
             order_by_date=True,
@@ -38,54 +47,189 @@ def generate_upload_report(date, team_name):
             exact_match=True,
         )
 
-        for spph in spphs:
-            upload = {
-                'package': spph.source_package_name,
-                'version': spph.source_package_version,
-                'series': lp.get_series_name(spph.distro_series_link),
-                'sponsor': lp.get_person_name(spph.sponsor_link),
-                'pocket': spph.pocket,
-            }
-
-            if upload['series'] == devel:
-                if upload['pocket'] == 'Release':
-                    # sucessful publish to devel release
-                    results['dev'] = results['dev'] + 1
-                    print_result(upload, 'dev')
-            else:
-                if upload['pocket'] == 'Updates':
-                    # sucessful SRU migration
-                    results['sru'] = results['sru'] + 1
-                    print_result(upload, 'sru')
-
-    return results
-
-
-def collect(team_name, dryrun=False):
+
+def _archive_publications(archive, packages, date):
+    """Yield every publication, from one archive-wide query."""
+    # pylint: disable=unused-argument
+    return archive.getPublishedSources(created_since_date=date,
+                                       order_by_date=True)
+
+
+PUBLICATION_QUERIES = {
+    'archive': _archive_publications,
+    'package': _package_publications,
+}
+'''ways of finding a team's publications: one query for the whole archive
+or one query per package of the team'''
+
+
+def find_uploads(date, team_name, mode='archive'):
+    """
+    Yield the publications created since date, with their upload category.
+
+    The category is 'dev' or 'sru' for a publication of one of the team's
+    packages that is a successful upload of that kind, None otherwise.
+    """
+    packages = set(
+        util.get_team_packages(util.get_launchpad_team_name(team_name)))
+    ubuntu = lp.get_ubuntu()
+    devel = ubuntu.current_series_link.split('/')[-1]
+    archive = ubuntu.main_archive
+
+    for spph in PUBLICATION_QUERIES[mode](archive, packages, date):
+        if spph.source_package_name not in packages:
+            yield spph, None
+            continue
+
+        upload = {
+            'package': spph.source_package_name,
+            'version': spph.source_package_version,
+            'series': lp.get_series_name(spph.distro_series_link),
+            'sponsor': lp.get_person_name(spph.sponsor_link),
+            'pocket': spph.pocket,
+        }
+
+        category = None
+        if upload['series'] == devel:
+            if upload['pocket'] == 'Release':
+                # sucessful publish to devel release
+                category = 'dev'
+        else:
+            if upload['pocket'] == 'Updates':
+                # sucessful SRU migration
+                category = 'sru'
+
+        if category:
+            print_result(upload, category)
+        yield spph, category
+
+
+def _state_path(team_name):
+    return os.path.join(get_cache_dir('uploads'), '%s.json' % team_name)
+
+
+def load_state(team_name):
+    """Return the saved upload report state of a team."""
+    try:
+        with open(_state_path(team_name)) as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {'watermark': None, 'days': {}}
+
+
+def save_state(team_name, state):
+    """Save the upload report state of a team, replacing it atomically."""
+    path = _state_path(team_name)
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path),
+                                     delete=False) as state_file:
+        json.dump(state, state_file, indent=1, sort_keys=True)
+    os.replace(state_file.name, path)
+
+
+def _days(first, last):
+    """Yield the days from first to last, inclusive, as strings."""
+    day = datetime.strptime(first, DAY_FORMAT)
+    while day <= datetime.strptime(last, DAY_FORMAT):
+        yield day.strftime(DAY_FORMAT)
+        day += timedelta(days=1)
+
+
+def _query_start(watermark):
+    """
+    Return the date to query publications from, for a watermark.
+
+    A watermark that is a day, rather than the creation time of a
+    publication, is already the start of that day and is used as is.
+    """
+    if 'T' not in watermark:
+        return watermark
+    start = datetime.strptime(watermark[:len('YYYY-MM-DDTHH:MM:SS')],
+                              TIME_FORMAT)
+    return (start - WATERMARK_MARGIN).strftime(TIME_FORMAT)
+
+
+def _new_day():
+    return {'dev': 0, 'sru': 0, 'publications': [], 'pushed': None}
+
+
+def update_upload_report(state, team_name, mode='archive'):
+    """
+    Count the uploads created since the watermark into per-day totals.
+
+    Each query starts WATERMARK_MARGIN before the watermark and
+    publications are deduplicated by self_link, as those created in the
+    margin are returned again by the next query. Each day's totals
+    record the publications counted in them and the totals last pushed.
+
+    :param state: state from load_state, updated in place
+    :return: the new watermark, to be saved once the totals are pushed
+    """
+    today = datetime.utcnow().strftime(DAY_FORMAT)
+    watermark = state['watermark'] or today
+    since = _query_start(watermark)
+    days = state['days']
+    for day in _days(since[:len(today)], today):
+        days.setdefault(day, _new_day())
+
+    newest = None
+    for spph, category in find_uploads(since, team_name, mode):
+        if newest is None or spph.date_created > newest:
+            newest = spph.date_created
+            watermark = newest.isoformat()
+        if not category:
+            continue
+
+        # Launchpad's day can already be past the local clock's today
+        day = days.setdefault(spph.date_created.strftime(DAY_FORMAT),
+                              _new_day())
+        if spph.self_link in day['publications']:
+            continue
+        day['publications'].append(spph.self_link)
+        day[category] += 1
+
+    return watermark
+
+
+def collect(team_name, dryrun=False, mode='archive'):
     """Push upload data."""
-    date = datetime.now().date().strftime('%Y-%m-%d')
-    results = generate_upload_report(date, team_name)
-    print('%s: %s' % (date, results))
+    state = load_state(team_name)
+    watermark = update_upload_report(state, team_name, mode)
+
+    data = []
+    for day, results in sorted(state['days'].items()):
+        totals = {'dev': results['dev'], 'sru': results['sru']}
+        print('%s: %s' % (day, totals))
+        if results['pushed'] != totals:
+            data.append({
+                'measurement': 'metric_uploads_%s' % team_name,
+                'time': datetime.strptime(day, DAY_FORMAT),
+                'fields': totals,
+            })
 
     if not dryrun:
         print('Pushing data...')
 
-        data = [
-            {
-                'measurement': 'metric_uploads_%s' % team_name,
-                'fields': {
-                    'dev': results['dev'],
-                    'sru': results['sru'],
-                }
-            }
-        ]
-
         util.influxdb_insert(data)
 
+        for results in state['days'].values():
+            results['pushed'] = {'dev': results['dev'], 'sru': results['sru']}
+        # publications before the day the next query starts on are never
+        # fetched again
+        first_day = _query_start(watermark)[:len('YYYY-MM-DD')]
+        state['days'] = {day: results
+                         for day, results in state['days'].items()
+                         if day >= first_day}
+        state['watermark'] = watermark
+        save_state(team_name, state)
+
 
 if __name__ == '__main__':
     PARSER = argparse.ArgumentParser()
     PARSER.add_argument('team_name', help='team name')
     PARSER.add_argument('--dryrun', action='store_true')
+    PARSER.add_argument('--mode', choices=sorted(PUBLICATION_QUERIES),
+                        default='archive',
+                        help='query the whole archive once (default) or '
+                        'each of the team\'s packages')
     ARGS = PARSER.parse_args()
-    collect(ARGS.team_name, ARGS.dryrun)
+    collect(ARGS.team_name, ARGS.dryrun, ARGS.mode)
@@ -6,11 +6,11 @@ Joshua Powers <josh.powers@canonical.com>
 """
 import argparse
 import re
-import urllib.request
 
 from bs4 import BeautifulSoup
 import requests
 
+from metrics.helpers import fetch
 from metrics.helpers import util
 
 BASE_URL = 'https://app.vagrantup.com/ubuntu'
@@ -19,8 +19,9 @@ BASE_URL = 'https://app.vagrantup.com/ubuntu'
 def get_vagrant_data():
     """Get download for specific release."""
     try:
-        page = requests.get(BASE_URL)
-    except urllib.error.HTTPError as exception:
+        page = fetch.get_session().get(BASE_URL)
+        page.raise_for_status()
+    except requests.HTTPError as exception:
         print('failed to get vagrant data')
         raise ValueError from exception
 
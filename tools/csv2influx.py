@@ -18,19 +18,8 @@ def _parse_value_type(value_type):
         raise ValueError('Unknown value_type: ', value_type)
 
 
-def csv2influx(csv_filename, measurement, use_tags=None, value_type=None):
-    """
-    Push CSV data to InfluxDB.
-
-    @param csv_filename: csv filename to load into InfluxDB
-    @param measurement: measurement name to use for data
-    @param use_tags: use these columns as tags, not value keys
-    @param value_type: cast value columns to this type
-    """
-    data = []
-
-    value_type = _parse_value_type(value_type or 'int')
-
+def _read_csv_points(csv_filename, measurement, use_tags, value_type):
+    """Generate InfluxDB points from the rows of a CSV file."""
     with open(csv_filename) as csv_file:
         reader = csv.DictReader(csv_file)
         for row in reader:
@@ -45,16 +34,37 @@ def csv2influx(csv_filename, measurement, use_tags=None, value_type=None):
                 print(row)
                 sys.exit(1)
 
-            entry = {
+            yield {
                 "measurement": measurement,
                 "fields": fields,
                 "tags": tags,
                 "time": date
             }
-            data.append(entry)
 
-    util.influxdb_insert(data)
-    print('wrote {} datapoints'.format(len(data)))
+
+def csv2influx(csv_filename, measurement, use_tags=None, value_type=None):
+    """
+    Push CSV data to InfluxDB.
+
+    The file is read twice: once to check every row, so that a malformed
+    row aborts the import before anything is written, then to stream the
+    rows to InfluxDB in batches. The whole file is never loaded into
+    memory.
+
+    @param csv_filename: csv filename to load into InfluxDB
+    @param measurement: measurement name to use for data
+    @param use_tags: use these columns as tags, not value keys
+    @param value_type: cast value columns to this type
+    """
+    value_type = _parse_value_type(value_type or 'int')
+
+    for _ in _read_csv_points(csv_filename, measurement, use_tags,
+                              value_type):
+        pass
+
+    data = _read_csv_points(csv_filename, measurement, use_tags, value_type)
+    written = util.influxdb_insert(data)
+    print('wrote {} datapoints'.format(written))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Check that the pending-sru report parses the same however it is split.
+
+PendingSRUReport.fetch feeds the report to its parser in chunks, and the
+parser is handed the text in pieces wherever a chunk ends. The report,
+a saved copy of it or a synthetic one by default, is parsed whole and
+split in chunks of every size up to --max-chunk and of the size fetch
+uses, and all the results are compared.
+"""
+import argparse
+
+from metrics.foundations_sru import PendingSRUReport
+from metrics.helpers import fetch
+
+RELEASES = ['xenial', 'bionic', 'focal']
+
+
+def _synthetic_report():
+    """Return a report shaped like pending-sru.html."""
+    parts = ['<html><body><h1>Pending SRUs</h1>\n',
+             '<h2>Upload queue status at a glance:</h2>\n',
+             '<table id="summary"><tr><th>Proposed</th></tr>',
+             '<tr><td>3 packages</td></tr></table>\n']
+    for number, release in enumerate(RELEASES):
+        parts.append('<h2>%s</h2>\n  \n<table id="%s">\n' % (release, release))
+        parts.append('<tr><th>Package</th><th>-release</th><th>-updates'
+                     '</th><th>-proposed</th><th>changelog bugs</th>'
+                     '<th>days</th></tr>\n')
+        for package in range(3):
+            parts.append(
+                '<tr><td><a href="#">pkg%d&amp;co</a> (autopkgtest '
+                'regression)</td><td>1.0</td><td>1.1</td><td>1.2</td>'
+                '<td><a class="verified">1%d</a> <a class="messages">2</a>'
+                '</td><td>%d</td></tr>\n' %
+                (package, number, number + package))
+        parts.append('</table>\n')
+    parts.append('</body></html>\n')
+    return ''.join(parts)
+
+
+def _chunks(text, size):
+    return [text[start:start + size] for start in range(0, len(text), size)]
+
+
+def check(text, max_chunk):
+    """Exit with an error if any chunk size gives a different result."""
+    expected = PendingSRUReport.parse([text]).tables
+    if not expected:
+        raise SystemExit('no release tables found')
+    print('%d tables: %s' % (len(expected), ', '.join(expected)))
+
+    sizes = list(range(1, max_chunk + 1)) + [fetch.CHUNK_SIZE]
+    for size in sizes:
+        tables = PendingSRUReport.parse(_chunks(text, size)).tables
+        if tables != expected:
+            raise SystemExit('chunks of %d characters give tables %s' %
+                             (size, ', '.join(tables)))
+    print('same result for %d chunk sizes' % len(sizes))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser()
+    PARSER.add_argument('report', nargs='?',
+                        help='saved pending-sru.html, synthetic by default')
+    PARSER.add_argument('--max-chunk', type=int, default=128,
+                        help='check every chunk size up to this one')
+    ARGS = PARSER.parse_args()
+    if ARGS.report:
+        with open(ARGS.report, encoding='utf-8', errors='replace') as REPORT:
+            TEXT = REPORT.read()
+    else:
+        TEXT = _synthetic_report()
+    check(TEXT, ARGS.max_chunk)
@@ -5,8 +5,7 @@ from collections import defaultdict
 from datetime import datetime, timedelta
 import sys
 
-import requests
-
+from metrics.helpers import fetch
 from metrics.helpers import util
 
 
@@ -92,7 +91,7 @@ def query_prometheus(url, params):
     @param url: URL to query against (e.g. http://IP:PORT/api/v1/query_range)
     @param params: dictionary of parameters
     """
-    response = requests.get(url, params=params)
+    response = fetch.get_session().get(url, params=params)
     if response.status_code != 200:
         print('%s %s: %s' % (response.status_code, response.reason,
                              response.text))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Measure how fast simplestreams filters evaluate cloud image items.
+
+The filter tree used by cloud_images is evaluated against synthetic items,
+both the way MultiFilter.matches used to (every child evaluated, item by
+item, through each SSFilter) and compiled into a single predicate.
+"""
+import argparse
+import random
+import timeit
+
+from metrics.cloud_images import filter_interesting_images
+from metrics.helpers.sstreams import compile_filter, ifilter, MultiFilter
+
+CLOUDS = ['aws', 'aws-cn', 'azure', 'gce', 'download', 'joyent', 'rax',
+          'ibm', 'oracle']
+INDEX_PATHS = ['releases', 'daily', 'minimal/releases', 'minimal/daily']
+RELEASES = ['trusty', 'xenial', 'bionic', 'cosmic', 'disco']
+
+
+def _synthetic_items(count, seed=0):
+    """Return count items shaped like cloud image stream items."""
+    rng = random.Random(seed)
+    items = []
+    for _ in range(count):
+        cloud = rng.choice(CLOUDS)
+        items.append({
+            'content_id': 'com.ubuntu.cloud:released:%s' % cloud,
+            'cloudname': '' if cloud == 'download' else cloud,
+            'datatype': ('image-downloads' if cloud == 'download'
+                         else 'image-ids'),
+            'index_path': rng.choice(INDEX_PATHS),
+            'release': rng.choice(RELEASES),
+            'arch': rng.choice(['amd64', 'arm64', 'i386']),
+            'virt': rng.choice(['hvm', 'pv', None]),
+            'root_store': rng.choice(['ssd', 'io1', 'ebs', None]),
+            'version_name': '20190%d01' % rng.randint(1, 9),
+        })
+    return items
+
+
+def _interpreted_matches(itemfilter, item):
+    """Evaluate a filter tree as MultiFilter.matches did before compiling."""
+    if isinstance(itemfilter, MultiFilter):
+        return itemfilter.operation(
+            [_interpreted_matches(f, item) for f in itemfilter.filters])
+    return itemfilter.matches(item)
+
+
+def benchmark(count, repeat):
+    """Print items per second of interpreted and compiled evaluation."""
+    aws_deprecated = (ifilter('release = xenial') &
+                      ifilter('virt ~ ^(hvm|pv)$') &
+                      ifilter('root_store ~ ^(io1|ebs)$'))
+    itemfilter = filter_interesting_images() & -aws_deprecated
+    items = _synthetic_items(count)
+
+    matches = compile_filter(itemfilter)
+    for item in items:
+        assert matches(item) == _interpreted_matches(itemfilter, item)
+
+    candidates = [
+        ('interpreted',
+         lambda: [_interpreted_matches(itemfilter, i) for i in items]),
+        ('compiled', lambda: [matches(i) for i in items]),
+    ]
+    for name, run in candidates:
+        best = min(timeit.repeat(run, number=1, repeat=repeat))
+        print('%-12s %10.0f items/s' % (name, count / best))
+
+    print('%d of %d items match' % (sum(1 for i in items if matches(i)),
+                                    count))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser()
+    PARSER.add_argument('--items', type=int, default=50000,
+                        help='number of synthetic items')
+    PARSER.add_argument('--repeat', type=int, default=5,
+                        help='best of this many runs is reported')
+    ARGS = PARSER.parse_args()
+    benchmark(ARGS.items, ARGS.repeat)